@@ -66,13 +66,82 @@ EMAIL_MAX_SENT=3
 EMAIL_VCODE_ATTEMPT=6
 # Max registrations from same ip per day
 REG_PER_IP=5
+# Key for POST /u/create_devices (bulk provisioning) without REG_PER_IP limit, "" - no key
+ADMIN_KEY=""
+# Max number of devices created by one POST /u/create_devices
+REG_BULK_MAX=5000
+# Number of update tokens (last accepted alive message) and ip addresses (registrations) kept in memory, to reject
+# too often alive messages and registrations over REG_PER_IP without database queries
+ADMISSION_CACHE=100000
+# Registrations from an ip are counted in the database at most once per (seconds) while they are over REG_PER_IP.
+# Devices which moved to another ip within this time are still counted. 0 - count on every registration
+REG_COUNT_CACHE=60
 # Websocket timeout (seconds, server side)
 WEBSOCKET_TIMEOUT=50
+# Max number of messages waiting to be sent to one websocket. When full, they are replaced with one refresh
+# (blackouts_ws_dropped metric). A client that doesn't read is disconnected after WEBSOCKET_TIMEOUT
+WEBSOCKET_QUEUE=8
+# Max number of subscriptions (+resource_id messages) per websocket
+WEBSOCKET_MAX_TARGETS=100
+
+# Number of worker processes. With more than one, websocket notifications are sent through PostgreSQL LISTEN/NOTIFY
+WORKERS=1
+# Use LISTEN/NOTIFY with one worker too, e.g. if several hosts use the same database
+PUBSUB=0
+# Updated devices are collected and published once per tick (seconds)
+PUBSUB_TICK=0.2
 # Refresh the home page no more than (seconds)
 ASTERISK_MIN_TIME=5
 
+# How to handle updates from devices (/u/<update_token>):
+# "orm" - load and save the device in the database on every update
+# "cache" - keep update state of all devices in memory (loaded at startup). Events (downtime, ip change) are written
+# immediately, last update times are written in bulk every HEARTBEAT_FLUSH_INTERVAL seconds and on shutdown.
+# On crash, last update times of up to HEARTBEAT_FLUSH_INTERVAL seconds are lost, events and settings are never lost.
+# Single process only (WORKERS=1)
+# "sql" - one statement (UPDATE ... RETURNING with event INSERT) per update, without transaction round trips
+HEARTBEAT_MODE="orm"
+# Should be much less than MIN_INTERVAL
+HEARTBEAT_FLUSH_INTERVAL=10
+# Max number of alive messages in one POST /u/bulk request (sent by collectors for many devices)
+HEARTBEAT_BULK_MAX=1000
+
+# How to search for isp and location by ip (ips table):
+# "memory" - sorted index in memory, loaded at startup and every IPS_RELOAD_INTERVAL seconds, no database queries
+# "gist" - GiST index on int8range(a, b) in the database, created at startup
+# "" - range query by separate a and b indexes
+IPS_INDEX="memory"
+IPS_RELOAD_INTERVAL=600
+# Number of ip addresses with country, isp, location and masked ip kept in memory
+MASKED_IPS_CACHE=10000
+# Number of cached listing, view and edit responses (with ETag). Dropped on device update
+# With LISTEN/NOTIFY (WORKERS > 1 or PUBSUB=1) only listing is cached
+RESPONSE_CACHE=1000
+# Max number of events on device page. Older events are loaded on demand
+EVENTS_PAGE_SIZE=500
+# Max number of devices in one /u/export request
+EXPORT_MAX_DEVICES=1000
+# Max number of devices and time windows in one /u/sla request, max window length (days)
+SLA_MAX_DEVICES=1000
+SLA_MAX_WINDOWS=10
+SLA_MAX_DAYS=3660
+# Count database statements, their time and sessions per request (X-SQL-* response headers)
+SQL_TRACE=0
+# Print traced requests with database time over (seconds), with SQL_TRACE_SLOWEST slowest statements
+SQL_TRACE_SLOW=0.1
+SQL_TRACE_SLOWEST=3
+# Events older than (days) are deleted once an hour, with daily summaries kept in events_daily table. 0 - keep forever
+# Device downtime and downtime charts don't change, old events can't be crossed out anymore
+EVENTS_RETENTION_DAYS=0
+# Events deleted in one transaction
+EVENTS_COMPACT_BATCH=1000
+# Max number of days on downtime chart
+CHART_MAX_DAYS=3660
+
 MAILER_TLS=True
 MAILER_SERVER="smtp.example.com"
+# 0 - default port (465 with MAILER_TLS, 25 without)
+MAILER_PORT=0
 MAILER_USERNAME="example@example.com"
 MAILER_PASSWORD="ExamplePassword"
 MAILER_EMAIL="Blackouts at Example <example@example.com>"
@@ -80,3 +149,13 @@ MAILER_URL="https://blackouts.example.com"
 #MAILER_URL="http://example.com/#"
 # Directly to api - make sure the unsubscribe link is working properly
 MAILER_UNSUBSCRIBE="https://blackouts.example.com/u/unsubscribe/"
+# Number of SMTP connections kept open and reused. Also the max number of emails being sent at once
+MAILER_POOL_SIZE=4
+# Emails are saved to the outbox table and sent in background, failed ones are retried
+# Max emails per minute (provider limit), 0 - unlimited
+MAILER_RATE=0
+MAILER_MAX_ATTEMPTS=8
+# Delay before the first retry (seconds), doubled on every next attempt
+MAILER_RETRY=60
+# Sent and failed emails are deleted from the outbox after (days)
+MAILER_KEEP_DAYS=30
@@ -15,26 +15,42 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from sanic import Sanic, Request, Websocket
-from sanic.response import text, json
+from sanic.response import text, json, raw, empty
 from sanic_ext import Extend
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, delete, func
-from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, DateTime, Boolean, Enum, ForeignKey
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
-from sqlalchemy.exc import PendingRollbackError
+from sqlalchemy import select, delete, func, bindparam, or_, cast, tuple_, text as sql, literal_column, literal, ARRAY
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Float, Date, DateTime, Boolean, Enum, ForeignKey, Index
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, load_only, object_session, Session
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
+from sqlalchemy.exc import PendingRollbackError, IntegrityError
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy import event
 from geoip import geolite2
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, date, timezone, timedelta
 from ipaddress import IPv4Address
 from random import SystemRandom
+from collections import OrderedDict, deque
+from bisect import bisect_right
+from array import array
+from types import SimpleNamespace
+from contextvars import ContextVar
+from json import dumps, loads
+import heapq
 import string
 import time
 import asyncio
 import re
 import traceback
+import os
+import hashlib
+import hmac
+import csv
+import io
 
 from CONFIG import *
 import mailer
+import metrics
 
 random = SystemRandom()
 
@@ -44,7 +60,69 @@ app.config.CORS_ORIGINS = ALLOW_ORIGIN
 app.config.CORS_AUTOMATIC_OPTIONS = True
 Extend(app)
 
-engine = create_async_engine(SQLALCHEMY_URL)
+metric_requests = metrics.histogram('blackouts_request_seconds', 'Request handling time, by handler', 'route')
+metric_db_acquire = metrics.histogram('blackouts_db_acquire_seconds', 'Waiting for a database connection from the pool').labels()
+metric_db_query = metrics.histogram('blackouts_db_query_seconds', 'Database statement execution time').labels()
+metric_heartbeats = metrics.counter('blackouts_heartbeats', 'Alive messages received').labels()
+metric_too_often = metrics.counter('blackouts_heartbeats_too_often', 'Alive messages rejected as too often').labels()
+metric_notify = metrics.histogram('blackouts_notify_seconds', 'Queuing messages to subscribers of one target').labels()
+metric_alerts_down = metrics.histogram('blackouts_alerts_down_seconds', 'One run of down alerts').labels()
+metric_ws_dropped = metrics.counter('blackouts_ws_dropped', 
+    'Messages dropped from full websocket queues, replaced by refresh').labels()
+
+class SQLTrace:
+    '''
+    Database use of one request (SQL_TRACE): statements, their total time, connections taken from the pool (sessions),
+    and the slowest statements. Set in request_started, found by engine events through sql_trace context variable
+    '''
+    __slots__ = ('queries', 'seconds', 'sessions', 'slowest')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.sessions = 0
+        # (seconds, statement), heap of SQL_TRACE_SLOWEST
+        self.slowest = []
+
+    def add(self, statement, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        item = (seconds, ' '.join(statement.split())[:300])
+        if len(self.slowest) < SQL_TRACE_SLOWEST:
+            heapq.heappush(self.slowest, item)
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+sql_trace = ContextVar('sql_trace', default=None)
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    '''
+    Records time spent waiting for a connection (blackouts_db_acquire_seconds)
+    '''
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metric_db_acquire.observe(time.perf_counter() - start)
+            trace = sql_trace.get()
+            if trace: trace.sessions += 1
+
+engine = create_async_engine(SQLALCHEMY_URL, poolclass=MeteredPool)
+
+@event.listens_for(engine.sync_engine, 'before_cursor_execute')
+def query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+@event.listens_for(engine.sync_engine, 'after_cursor_execute')
+def query_end(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start']
+    metric_db_query.observe(seconds)
+    trace = sql_trace.get()
+    if trace: trace.add(statement, seconds)
+
+# For single statements, without BEGIN and COMMIT round trips
+autocommit = engine.execution_options(isolation_level="AUTOCOMMIT")
 Base = declarative_base()
 dba = sessionmaker(engine, class_=AsyncSession)
 
@@ -64,7 +142,7 @@ class Device(Base):
     public = Column(Boolean, index=True, default=False)
     # Update interval (seconds). Downtime will be written if device was down interval * BLACKOUT_COEFFICIENT
     interval = Column(Integer, default=DEFAULT_INTERVAL)
-    # Interval for down notifications (seconds). Used in alerts_down
+    # Interval for down notifications (seconds). Used in alerts scheduler
     notify_interval = Column(Integer, default=int(DEFAULT_INTERVAL * BLACKOUT_COEFFICIENT))
     email = Column(String(255), default='')
     # The number of sent letters. Used with EMAIL_MAX_SENT
@@ -118,6 +196,13 @@ class Event(Base):
     device_id = Column(Integer, ForeignKey("device.id"))
     device = relationship("Device", back_populates="events")
 
+# For events pages (get_device_js), newest first
+events_device_index = Index('ix_events_device_ended', Event.device_id, Event.ended, Event.id)
+
+DEVICE_TOKENS = ('view_token', 'update_token', 'edit_token')
+# Token collisions are caught by these on insert (see devices_insert), instead of checking every new token
+device_token_indexes = [ Index('ux_device_' + tok, getattr(Device, tok), unique=True) for tok in DEVICE_TOKENS ]
+
 class IPs(Base):
     __tablename__ = "ips"
 
@@ -129,42 +214,517 @@ class IPs(Base):
     isp = Column(String(50))
     location = Column(String(100))
 
+# IP range as int8range, for GiST index and containment queries (IPS_INDEX = "gist")
+ips_range = func.int8range(IPs.a, IPs.b, literal_column("'[]'"))
+ips_range_index = Index('ix_ips_range', ips_range, postgresql_using='gist')
+
+class DowntimeDaily(Base):
+    '''
+    Downtime events split by UTC days, for charts. Maintained by update and toogle_event
+    '''
+    __tablename__ = "downtime_daily"
+
+    device_id = Column(Integer, ForeignKey("device.id"), primary_key=True)
+    # UTC date
+    day = Column(Date, primary_key=True)
+    # Downtime, not crossed
+    down_seconds = Column(Integer, default=0)
+    # Downtime excluded by user (crossed)
+    crossed_seconds = Column(Integer, default=0)
+    # [[start, end, event id, crossed], ...], start and end are seconds since UTC midnight
+    segments = Column(JSONB, default=list)
+
+# Fills downtime_daily from existing events, same as rollup_add does for new ones
+ROLLUP_BACKFILL_SQL = sql('''
+INSERT INTO downtime_daily (device_id, day, down_seconds, crossed_seconds, segments)
+SELECT device_id, day, SUM(CASE WHEN crossed THEN 0 ELSE e - s END), SUM(CASE WHEN crossed THEN e - s ELSE 0 END),
+    jsonb_agg(jsonb_build_array(s, e, id, crossed) ORDER BY s)
+FROM (
+    SELECT events.device_id, events.id, COALESCE(events.crossed, false) AS crossed, d::date AS day,
+        ROUND(EXTRACT(EPOCH FROM GREATEST(events.started, d) - d))::integer AS s,
+        ROUND(EXTRACT(EPOCH FROM LEAST(events.ended, d + interval '1 day') - d))::integer AS e
+    FROM events, generate_series(date_trunc('day', events.started), events.ended, interval '1 day') AS d
+    WHERE events.downtime IS NOT NULL AND events.started IS NOT NULL
+) AS segments
+WHERE e > s
+GROUP BY device_id, day
+ON CONFLICT DO NOTHING
+''')
+
+class DowntimePrefix(Base):
+    '''
+    Downtime events of each device in order of end, with running totals up to and including the event, 
+    so downtime and number of outages in any time window are differences of two rows (see sla). 
+    Maintained by update and toogle_event, kept when events are compacted
+    '''
+    __tablename__ = "downtime_prefix"
+
+    device_id = Column(Integer, ForeignKey("device.id"), primary_key=True)
+    ended = Column(DateTime, primary_key=True)
+    event_id = Column(Integer, primary_key=True)
+    started = Column(DateTime)
+    downtime = Column(Integer)
+    crossed = Column(Boolean, default=False)
+    # Running totals: all events, and not crossed (excluded by user) ones
+    outages = Column(Integer)
+    downtime_sum = Column(BigInteger)
+    uncrossed_outages = Column(Integer)
+    uncrossed_sum = Column(BigInteger)
+
+# Fills downtime_prefix from existing events, same as rollup_add does for new ones
+PREFIX_BACKFILL_SQL = sql('''
+INSERT INTO downtime_prefix (device_id, ended, event_id, started, downtime, crossed, outages, downtime_sum, 
+    uncrossed_outages, uncrossed_sum)
+SELECT device_id, ended, id, started, downtime, crossed, COUNT(*) OVER w, SUM(downtime) OVER w, 
+    COUNT(*) FILTER (WHERE NOT crossed) OVER w, COALESCE(SUM(downtime) FILTER (WHERE NOT crossed) OVER w, 0)
+FROM (
+    SELECT device_id, ended, id, started, downtime, COALESCE(crossed, false) AS crossed FROM events
+    WHERE downtime IS NOT NULL AND started IS NOT NULL AND device_id IS NOT NULL
+) AS e
+WINDOW w AS (PARTITION BY device_id ORDER BY ended, id)
+ON CONFLICT DO NOTHING
+''')
+
+# Appends event after the last one of the device
+PREFIX_ADD_SQL = sql('''
+INSERT INTO downtime_prefix (device_id, ended, event_id, started, downtime, crossed, outages, downtime_sum, 
+    uncrossed_outages, uncrossed_sum)
+SELECT CAST(:device_id AS integer), CAST(:ended AS timestamp), CAST(:event_id AS integer), CAST(:started AS timestamp),
+    CAST(:downtime AS integer), false, COALESCE(p.outages, 0) + 1, COALESCE(p.downtime_sum, 0) + :downtime, 
+    COALESCE(p.uncrossed_outages, 0) + 1, COALESCE(p.uncrossed_sum, 0) + :downtime
+FROM (SELECT 1) AS x LEFT JOIN LATERAL (
+    SELECT * FROM downtime_prefix WHERE device_id = :device_id ORDER BY ended DESC, event_id DESC LIMIT 1
+) AS p ON true
+''')
+
+# Sets crossed state of event, and corrects not crossed totals of it and all later events of the device
+PREFIX_TOOGLE_SQL = sql('''
+WITH t AS (
+    SELECT ended, event_id, downtime, CASE WHEN :crossed THEN -1 ELSE 1 END AS sign FROM downtime_prefix
+    WHERE device_id = :device_id AND ended = :ended AND event_id = :event_id AND crossed <> :crossed
+)
+UPDATE downtime_prefix AS p SET crossed = CASE WHEN p.event_id = t.event_id THEN :crossed ELSE p.crossed END,
+    uncrossed_outages = p.uncrossed_outages + t.sign, uncrossed_sum = p.uncrossed_sum + t.sign * t.downtime
+FROM t WHERE p.device_id = :device_id AND (p.ended, p.event_id) >= (t.ended, t.event_id)
+''')
+
+class EventsDaily(Base):
+    '''
+    Summaries of events older than EVENTS_RETENTION_DAYS by UTC day of event end, written by events_compact
+    '''
+    __tablename__ = "events_daily"
+
+    device_id = Column(Integer, ForeignKey("device.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    events = Column(Integer, default=0)
+    # Events with downtime
+    outages = Column(Integer, default=0)
+    # Downtime of events, not crossed and crossed (excluded by user)
+    downtime = Column(Integer, default=0)
+    crossed_downtime = Column(Integer, default=0)
+    # Distinct new ip addresses
+    ips = Column(JSONB, default=list)
+
+# Deletes a batch of old events (oldest ids first, so the primary key index is enough) and adds them to events_daily
+EVENTS_COMPACT_SQL = sql('''
+WITH old AS (
+    DELETE FROM events WHERE id IN (
+        SELECT id FROM events WHERE ended < :cutoff ORDER BY id LIMIT :batch FOR UPDATE SKIP LOCKED
+    )
+    RETURNING device_id, ended, downtime, COALESCE(crossed, false) AS crossed, new_ip
+), summary AS (
+    INSERT INTO events_daily (device_id, day, events, outages, downtime, crossed_downtime, ips)
+    SELECT device_id, ended::date, COUNT(*), COUNT(downtime), 
+        COALESCE(SUM(downtime) FILTER (WHERE NOT crossed), 0), COALESCE(SUM(downtime) FILTER (WHERE crossed), 0),
+        COALESCE(jsonb_agg(DISTINCT new_ip) FILTER (WHERE new_ip IS NOT NULL), '[]')
+    FROM old WHERE device_id IS NOT NULL GROUP BY device_id, ended::date
+    ON CONFLICT (device_id, day) DO UPDATE SET events = events_daily.events + excluded.events, 
+        outages = events_daily.outages + excluded.outages, downtime = events_daily.downtime + excluded.downtime,
+        crossed_downtime = events_daily.crossed_downtime + excluded.crossed_downtime,
+        ips = (SELECT COALESCE(jsonb_agg(DISTINCT ip), '[]') FROM jsonb_array_elements(events_daily.ips || excluded.ips) AS ip)
+)
+SELECT device_id, COUNT(*) AS events FROM old GROUP BY device_id
+''')
+
+class Outbox(Base):
+    '''
+    Emails to send. Added in the same transaction as the change they are about, sent by outbox_loop
+    '''
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    created = Column(DateTime)
+    # Name of mailer function (OUTBOX_KINDS), called as kind(email, *args)
+    kind = Column(String(20))
+    email = Column(String(255))
+    args = Column(JSONB, default=list)
+    # pending, sent, failed (MAILER_MAX_ATTEMPTS reached)
+    status = Column(String(10), index=True, default='pending')
+    attempts = Column(Integer, default=0)
+    # Next try, or end of lease when claimed by a worker
+    next_attempt = Column(DateTime, index=True)
+    sent = Column(DateTime)
+    # Last error
+    error = Column(Text)
+
+# pg_advisory_xact_lock key for table creation and backfills at startup
+SCHEMA_LOCK = 0x626c6b6f
+
 @app.listener("before_server_start")
 async def initialize(app, loop):
     '''
-    Create tables and start alerts_loop
+    Create tables, load in-memory state and start background loops
     '''
     async with engine.begin() as db:
+        # Every worker runs this, one at a time. The lock is released on commit, next workers find tables and 
+        # indexes created and backfills done
+        await db.execute(sql('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK})
         await db.run_sync(Base.metadata.create_all)
-
+        # create_all doesn't add indexes to existing tables
+        await db.run_sync(lambda db: events_device_index.create(db, checkfirst=True))
+        for index in device_token_indexes:
+            await db.run_sync(lambda db: index.create(db, checkfirst=True))
+        # New downtime_daily table, fill it in the same transaction
+        if not await db.scalar(select(func.count()).select_from(select(DowntimeDaily.day).limit(1).subquery())):
+            await db.execute(ROLLUP_BACKFILL_SQL)
+        if not await db.scalar(select(func.count()).select_from(select(DowntimePrefix.ended).limit(1).subquery())):
+            await db.execute(PREFIX_BACKFILL_SQL)
+        if IPS_INDEX == 'gist':
+            await db.run_sync(lambda db: ips_range_index.create(db, checkfirst=True))
+
+    if IPS_INDEX == 'memory':
+        await ips_index.load()
+    asyncio.create_task(ips_reload_loop())
+
+    if HEARTBEAT_MODE == 'cache':
+        await heartbeat_warm()
+        asyncio.create_task(heartbeat_flush_loop())
+
+    await alerts_reconcile()
     asyncio.create_task(alerts_loop())
+    asyncio.create_task(outbox_loop())
+    asyncio.create_task(ws_reaper_loop())
+    if EVENTS_RETENTION_DAYS:
+        asyncio.create_task(events_compact_loop())
 
+    if PUBSUB or WORKERS > 1:
+        pubsub.listener = asyncio.create_task(pubsub_listen_loop())
+
+@app.listener("after_server_stop")
+async def finalize(app, loop):
+    '''
+    Write not yet flushed heartbeats, close SMTP and LISTEN connections
+    '''
+    if HEARTBEAT_MODE == 'cache':
+        await heartbeat_flush()
+    await mailer.close()
+    if pubsub.listener:
+        pubsub.listener.cancel()
+        try:
+            await pubsub.listener
+        except asyncio.CancelledError:
+            pass
+
+
+class alerts:
+    # Min-heap of (deadline, device id, generation). Entries with an outdated generation are skipped
+    heap = []
+    # device id: generation of the current heap entry
+    scheduled = {}
+    # device id: notify_interval, for devices with down notifications enabled
+    watched = {}
+    generation = 0
+    # Set when a deadline earlier than the nearest one is scheduled
+    wakeup = None
+
+def alerts_push(device_id, deadline):
+    alerts.generation += 1
+    alerts.scheduled[device_id] = alerts.generation
+    entry = (deadline, device_id, alerts.generation)
+    heapq.heappush(alerts.heap, entry)
+    if alerts.heap[0] is entry and alerts.wakeup:
+        alerts.wakeup.set()
+
+def alerts_since(now):
+    '''
+    Devices down since before it are not emailed: down for too long, when notifications are enabled or on startup
+    '''
+    return now - timedelta(seconds=MAX_INTERVAL + MIN_INTERVAL * 2)
+
+def alerts_schedule(device_id, updated):
+    '''
+    Sets down alert deadline of a watched device to updated + notify_interval. Called on every alive message
+    '''
+    interval = alerts.watched.get(device_id)
+    if interval and updated and updated > alerts_since(datetime.utcnow()):
+        alerts_push(device_id, updated + timedelta(seconds=interval))
+
+def alerts_set(device_id, interval, updated, notified_down):
+    '''
+    Updates down alert state of device in this process. interval - notify_interval, None if not watched
+    '''
+    alerts.scheduled.pop(device_id, None)
+    if interval:
+        alerts.watched[device_id] = interval
+        if not notified_down:
+            alerts_schedule(device_id, updated)
+    else:
+        alerts.watched.pop(device_id, None)
+
+def alerts_interval(device):
+    '''
+    notify_interval if down notifications are enabled, None otherwise
+    '''
+    return device.notify_interval if device.edit_token and device.notifyoff and device.email_confirmed else None
+
+def alerts_watch(device):
+    '''
+    Updates down alert state from device object. Must be called on every change of notification settings.
+    With LISTEN/NOTIFY, other processes get it too, as alive messages of the device may come to any of them
+    '''
+    interval = alerts_interval(device)
+    updated = heartbeat_updated(device)
+    alerts_set(device.id, interval, updated, device.notified_down)
+    if PUBSUB or WORKERS > 1:
+        pubsub_publish(['!' + str(device.id)], {'interval': interval, 'updated': updated, 
+            'notified_down': bool(device.notified_down)})
+
+async def alerts_reconcile():
+    '''
+    Builds down alert deadlines from the database, on startup
+    '''
+    async with dba() as orm:
+        rs = await orm.execute(select(Device.id, Device.notify_interval, Device.updated, Device.notified_down).filter_by(
+            notifyoff=True, email_confirmed=True).where(Device.edit_token != None))
+        for device_id, interval, updated, notified_down in rs:
+            alerts.watched[device_id] = interval
+            if not notified_down:
+                alerts_schedule(device_id, updated)
+    print('ALERTS - watching', len(alerts.watched), 'devices')
 
 async def alerts_loop():
     '''
-    Email down devices
+    Sleeps until the nearest down alert deadline, or until an earlier deadline is scheduled
     '''
+    alerts.wakeup = asyncio.Event()
     while True:
-        asyncio.create_task(alerts_down())
-        await asyncio.sleep(MIN_INTERVAL)
+        alerts.wakeup.clear()
+        now = datetime.utcnow()
+        due = []
+        while alerts.heap and alerts.heap[0][0] <= now:
+            deadline, device_id, generation = heapq.heappop(alerts.heap)
+            if alerts.scheduled.get(device_id) == generation:
+                del alerts.scheduled[device_id]
+                due.append(device_id)
+
+        if due:
+            try:
+                await alerts_down(due, now)
+            except:
+                traceback.print_exc()
+                # Retry later, unless rescheduled by an alive message
+                for device_id in due:
+                    if device_id not in alerts.scheduled:
+                        alerts_push(device_id, now + timedelta(seconds=MIN_INTERVAL))
+            continue
+
+        timeout = (alerts.heap[0][0] - now).total_seconds() if alerts.heap else None
+        try:
+            await asyncio.wait_for(alerts.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
 
-async def alerts_down():
+# Marks devices as notified, if they are still down and notifications are still enabled. Not if they went down before
+# alerts_since, as the query run every minute before. The database decides, so several processes never email the same downtime twice.
+# m.updated - last update time kept in memory (cache mode), may be newer than in the database
+ALERTS_SQL = sql('''
+UPDATE device SET notified_down = true
+FROM unnest(CAST(:ids AS integer[]), CAST(:updated AS timestamp[])) AS m(id, updated)
+WHERE device.id = m.id AND NOT device.notified_down AND device.notifyoff AND device.email_confirmed 
+    AND device.edit_token IS NOT NULL
+    AND GREATEST(device.updated, m.updated) <= CAST(:now AS timestamp) - make_interval(secs => device.notify_interval)
+    AND GREATEST(device.updated, m.updated) > CAST(:since AS timestamp)
+RETURNING device.id, device.email, device.title, device.edit_token
+''')
+
+async def alerts_down(ids, now):
     '''
     Email down devices
     '''
-    async with dba() as orm:
-        now = datetime.utcnow()
-        rs = await orm.scalars(select(Device).filter_by(notifyoff=True, email_confirmed=True, notified_down=False).where(
-            Device.updated < now - timedelta(seconds=MIN_INTERVAL),
-            Device.updated > now - timedelta(seconds=MAX_INTERVAL + MIN_INTERVAL * 2)))
+    start = time.perf_counter()
+    updated = [ heartbeats.ids[i].updated if i in heartbeats.ids else None for i in ids ]
+    async with engine.begin() as db:
+        rs = (await db.execute(ALERTS_SQL, {'ids': ids, 'updated': updated, 'now': now, 'since': alerts_since(now)})).all()
         for device in rs:
+            await outbox_add(db, 'device_down', device.email, device.title, device.edit_token)
+    outbox_wakeup()
+
+    for device in rs:
+        state = heartbeats.ids.get(device.id)
+        if state:
+            # Next alive message goes to the database and resets notified_down
+            state.notified_down = True
+
+    # Still alive or settings changed, maybe by another process. Schedule again from the database state
+    missed = set(ids) - { device.id for device in rs }
+    if missed:
+        async with dba() as orm:
+            for device in await orm.scalars(select(Device).where(Device.id.in_(missed)).options(load_only(Device.id, 
+                    Device.edit_token, Device.notifyoff, Device.email_confirmed, Device.notify_interval, Device.updated, 
+                    Device.notified_down))):
+                alerts_set(device.id, alerts_interval(device), heartbeat_updated(device), device.notified_down)
+    metric_alerts_down.observe(time.perf_counter() - start)
+
+OUTBOX_KINDS = ('device_down', 'device_up', 'device_vcode')
+# Claimed emails are sent again, if not marked as sent or failed within this time (crash)
+OUTBOX_LEASE = 600
+
+class outbox:
+    # Set when new emails are committed
+    wakeup = None
+    # Claim times (time.monotonic) within the last minute, for MAILER_RATE
+    claimed = deque()
+    # Last cleanup (time.monotonic)
+    cleaned = 0
+
+async def outbox_add(orm, kind, email, *args):
+    '''
+    Adds email to outbox in current transaction. Call outbox_wakeup after commit to send it immediately
+    '''
+    if kind not in OUTBOX_KINDS: raise NameError('Incorrect kind')
+    now = datetime.utcnow()
+    await orm.execute(Outbox.__table__.insert().values(created=now, kind=kind, email=email, args=list(args), status='pending',
+        attempts=0, next_attempt=now))
+
+def outbox_wakeup():
+    if outbox.wakeup:
+        outbox.wakeup.set()
+
+def outbox_quota():
+    '''
+    Number of emails that can be claimed now: one batch per mailer pool, no more than MAILER_RATE per minute
+    '''
+    limit = MAILER_POOL_SIZE * 4
+    if not MAILER_RATE: return limit
+    now = time.monotonic()
+    while outbox.claimed and outbox.claimed[0] <= now - 60:
+        outbox.claimed.popleft()
+    return min(limit, MAILER_RATE - len(outbox.claimed))
+
+# Several processes can run outbox_loop, SKIP LOCKED gives each email to one of them
+OUTBOX_CLAIM_SQL = sql('''
+UPDATE outbox SET attempts = outbox.attempts + 1, next_attempt = CAST(:lease AS timestamp)
+WHERE id IN (
+    SELECT id FROM outbox WHERE status = 'pending' AND next_attempt <= CAST(:now AS timestamp) 
+    ORDER BY next_attempt LIMIT :limit FOR UPDATE SKIP LOCKED
+)
+RETURNING id, kind, email, args, attempts
+''')
+
+async def outbox_deliver(message):
+    '''
+    Sends claimed email. Returns parameters for the status update
+    '''
+    try:
+        await getattr(mailer, message.kind)(message.email, *message.args)
+        return {'_id': message.id, '_status': 'sent', '_next': None, '_sent': datetime.utcnow(), '_error': None}
+    except Exception as e:
+        traceback.print_exc()
+        # Exponential backoff: MAILER_RETRY, 2 * MAILER_RETRY, 4 * MAILER_RETRY...
+        delay = min(MAILER_RETRY * 2 ** (message.attempts - 1), 86400)
+        return {'_id': message.id, '_status': 'failed' if message.attempts >= MAILER_MAX_ATTEMPTS else 'pending', 
+            '_next': datetime.utcnow() + timedelta(seconds=delay), '_sent': None, '_error': repr(e)[:1000]}
+
+async def outbox_send():
+    '''
+    Claims due emails, sends them and records delivery status. Returns the number of claimed emails
+    '''
+    limit = outbox_quota()
+    if limit <= 0: return 0
+
+    now = datetime.utcnow()
+    async with autocommit.connect() as db:
+        rs = (await db.execute(OUTBOX_CLAIM_SQL, {'now': now, 'lease': now + timedelta(seconds=OUTBOX_LEASE), 
+            'limit': limit})).all()
+    if not rs: return 0
+
+    if MAILER_RATE:
+        outbox.claimed.extend([time.monotonic()] * len(rs))
+
+    # Concurrency is limited by the mailer pool (MAILER_POOL_SIZE)
+    results = await asyncio.gather(*[ outbox_deliver(message) for message in rs ])
+
+    table = Outbox.__table__
+    async with autocommit.connect() as db:
+        await db.execute(table.update().where(table.c.id == bindparam('_id')).values(status=bindparam('_status'), 
+            next_attempt=bindparam('_next'), sent=bindparam('_sent'), error=bindparam('_error')), results)
+    return len(rs)
+
+async def outbox_cleanup():
+    '''
+    Deletes sent and failed emails older than MAILER_KEEP_DAYS, once an hour
+    '''
+    if time.monotonic() - outbox.cleaned < 3600: return
+    outbox.cleaned = time.monotonic()
+    async with autocommit.connect() as db:
+        await db.execute(delete(Outbox).where(Outbox.status != 'pending', 
+            Outbox.created < datetime.utcnow() - timedelta(days=MAILER_KEEP_DAYS)))
+
+async def outbox_loop():
+    '''
+    Sends emails from outbox. Wakes up on new emails, checks for retries every MIN_INTERVAL seconds
+    '''
+    outbox.wakeup = asyncio.Event()
+    while True:
+        outbox.wakeup.clear()
+        try:
+            if await outbox_send():
+                continue
+            await outbox_cleanup()
+        except:
+            traceback.print_exc()
+
+        try:
+            await asyncio.wait_for(outbox.wakeup.wait(), MIN_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+class retention:
+    # time.monotonic() of the last events_compact
+    compacted = 0
+
+async def events_compact():
+    '''
+    Moves events older than EVENTS_RETENTION_DAYS to events_daily, in batches of EVENTS_COMPACT_BATCH, 
+    each in its own transaction. Device downtime and downtime_daily (charts) are kept. Returns the number of moved events
+    '''
+    cutoff = datetime.utcnow() - timedelta(days=EVENTS_RETENTION_DAYS)
+    total = 0
+    while True:
+        async with engine.begin() as db:
+            rows = (await db.execute(EVENTS_COMPACT_SQL, {'cutoff': cutoff, 'batch': EVENTS_COMPACT_BATCH})).all()
+        moved = sum(row.events for row in rows)
+        total += moved
+        for row in rows:
+            responses_invalidate(row.device_id)
+        if moved < EVENTS_COMPACT_BATCH:
+            return total
+        # Let alive messages in between batches
+        await asyncio.sleep(0.1)
+
+async def events_compact_loop():
+    '''
+    Runs events_compact once an hour
+    '''
+    while True:
+        if time.monotonic() - retention.compacted >= 3600:
+            retention.compacted = time.monotonic()
             try:
-                if device.updated < now - timedelta(seconds=device.notify_interval):
-                    asyncio.create_task(mailer.device_down(device.email, device.title, device.edit_token))
-                    device.notified_down = True
+                moved = await events_compact()
+                if moved: print('RETENTION - compacted', moved, 'events')
             except:
                 traceback.print_exc()
-        await orm.commit()
+        await asyncio.sleep(60)
 
 def random_str(l=20):
     return ''.join( [ random.choice(string.ascii_lowercase) for _ in range(20) ] )
@@ -183,57 +743,344 @@ def json_serial(obj):
         return obj.replace(tzinfo=timezone.utc).isoformat()
     raise TypeError ("Type %s not serializable" % type(obj))
 
+class LRU:
+    '''
+    Bounded dict, drops least recently used items
+    '''
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return default
+        return self.items[key]
+
+    def set(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+class responses:
+    # Serialized responses of listing, view and edit pages. uri: (key, etag, body)
+    # key - device id, or * for listing
+    cached = LRU(RESPONSE_CACHE)
+    # key: uris
+    keys = {}
+    # Incremented on every invalidation
+    generation = 0
+    # key: generation of its last invalidation
+    invalidated = {}
+    # Generation of the last responses_clear
+    cleared = 0
+
+def responses_invalidate(key):
+    '''
+    Drops cached responses of device id or listing (*). Called from ws_dispatch
+    '''
+    responses.generation += 1
+    responses.invalidated[key] = responses.generation
+    for uri in responses.keys.pop(key, ()):
+        responses.cached.pop(uri)
+
+def responses_clear():
+    '''
+    Drops all cached responses (ips table changed)
+    '''
+    responses.generation += 1
+    responses.cleared = responses.generation
+    responses.cached.clear()
+    responses.keys.clear()
+
+def etag_response(request, etag, body):
+    if request.headers.get('if-none-match') == etag:
+        return empty(status=304, headers={'ETag': etag})
+    return raw(body, content_type='application/json', headers={'ETag': etag})
+
+def cached_response(request):
+    '''
+    Returns response from cache for requests without query string, or None
+    '''
+    if request.query_string: return None
+    entry = responses.cached.get(request.path)
+    if entry:
+        return etag_response(request, entry[1], entry[2])
+
+def cache_response(request, key, generation, js):
+    '''
+    Serializes js with ETag (content hash). Saves it to cache, if key was not invalidated 
+    after generation (taken before the database was read)
+    '''
+    body = json(js, default=json_serial).body
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    # Other processes drop cached responses PUBSUB_TICK later. Device pages must change right after edit, 
+    # so with several processes only listing is cached
+    if (PUBSUB or WORKERS > 1) and key != '*': return etag_response(request, etag, body)
+
+    if not request.query_string and max(responses.invalidated.get(key, 0), responses.cleared) <= generation:
+        responses.cached.set(request.path, (key, etag, body))
+        responses.keys.setdefault(key, set()).add(request.path)
+    return etag_response(request, etag, body)
+
 @app.get("/u/listing")
 async def listing(request):
     '''
     /u/listing - public device listing for main page
     '''
+    res = cached_response(request)
+    if res: return res
+    generation = responses.generation
+
     async with dba() as orm:
         columns = ('id', 'title', 'isp', 'location', 'created', 'updated', 'downtime', 'downtime_uncrossed', 'interval')
         devices = await orm.scalars(select(Device).filter_by(public=True).order_by(Device.id))
-        return json({'devices': [ { k: device.__dict__[k] for k in columns } for device in devices ], 
+        return cache_response(request, '*', generation, {'devices': [ 
+            { k: heartbeat_updated(device) if k == 'updated' else device.__dict__[k] for k in columns } for device in devices ], 
             'total': await orm.scalar(select(func.count()).select_from(Device))
-            }, default=json_serial)
+            })
 
-async def mask_ip(ip):
+class IPIndex:
     '''
-    Removes last octet from ip address. Search for isp, location and country
+    Sorted in-memory index of ips table (IPS_INDEX = "memory"). Lookup is a binary search by range start
     '''
-    if not ip: return None
+    def __init__(self):
+        # Range starts, sorted
+        self.starts = array('q')
+        # Range ends
+        self.ends = array('q')
+        # Max of ends up to this position. Overlapping ranges are allowed, but only disjoint ones give O(log n)
+        self.reach = array('q')
+        # IPs objects or rows with isp and location
+        self.rows = []
+
+    def build(self, rows):
+        '''
+        Builds index from IPs objects or rows. Replaces old index at once, so lookups never see a partial one
+        '''
+        rows = sorted(rows, key=lambda row: (row.a, row.b))
+        starts, ends, reach = array('q'), array('q'), array('q')
+        for row in rows:
+            starts.append(row.a)
+            ends.append(row.b)
+            reach.append(max(row.b, reach[-1]) if reach else row.b)
+        self.starts, self.ends, self.reach, self.rows = starts, ends, reach, rows
+
+    async def load(self):
+        async with dba() as orm:
+            # Plain rows instead of IPs objects, several times faster to load
+            self.build((await orm.execute(select(IPs.a, IPs.b, IPs.isp, IPs.location))).all())
+
+    def lookup(self, ip_int):
+        '''
+        Returns row with range containing ip_int, or None
+        '''
+        n = bisect_right(self.starts, ip_int) - 1
+        while n >= 0 and self.reach[n] >= ip_int:
+            if self.ends[n] >= ip_int:
+                return self.rows[n]
+            n -= 1
+        return None
+
+ips_index = IPIndex()
+
+class IPInfo:
+    '''
+    Country (geolite2, None if unknown), isp and location (ips table) and masked ip (see mask_ip) of ip address.
+    isp, location and masked are None until loaded by ip_infos_many
+    '''
+    __slots__ = ('country', 'isp', 'location', 'masked')
 
-    async with dba() as orm:
-        ip_int = int(IPv4Address(ip))
-        ip_info = await orm.scalar(select(IPs).filter(IPs.a <= ip_int, IPs.b >= ip_int))
-        ipc = ip.split('.')
-        ipc[3] = '*'
+    def __init__(self, country):
+        self.country = country
+        self.isp = self.location = self.masked = None
+
+# ip: IPInfo, shared by all requests
+ip_infos = LRU(MASKED_IPS_CACHE)
+
+async def ips_reload_loop():
+    '''
+    Every IPS_RELOAD_INTERVAL seconds reloads ips_index and clears ip_infos and cached responses, 
+    as ips table may be changed by add_ip in another process
+    '''
+    while True:
+        await asyncio.sleep(IPS_RELOAD_INTERVAL)
+        try:
+            if IPS_INDEX == 'memory':
+                await ips_index.load()
+            ip_infos.clear()
+            responses_clear()
+        except:
+            traceback.print_exc()
+
+async def ip_lookup_many(orm, ips):
+    '''
+    Search for isp and location (IPs objects or rows) by ip addresses, in one query at most. Returns dict ip: row
+    '''
+    ip_ints = { ip: int(IPv4Address(ip)) for ip in ips }
+    if IPS_INDEX == 'memory':
+        return { ip: ips_index.lookup(ip_int) for ip, ip_int in ip_ints.items() }
+
+    if not ip_ints: return {}
+    if IPS_INDEX == 'gist':
+        condition = "int8range(ips.a, ips.b, '[]') @> t.ip"
+    else:
+        condition = "ips.a <= t.ip AND ips.b >= t.ip"
+    rs = await orm.execute(sql("SELECT DISTINCT ON (t.ip) t.ip, ips.isp, ips.location " +
+        "FROM unnest(CAST(:ips AS bigint[])) AS t(ip) JOIN ips ON " + condition), {'ips': list(ip_ints.values())})
+    rows = { row.ip: row for row in rs }
+    return { ip: rows.get(ip_int) for ip, ip_int in ip_ints.items() }
+
+def ip_info_get(ip):
+    '''
+    IPInfo of ip address from ip_infos, with country looked up if it's not there
+    '''
+    info = ip_infos.get(ip)
+    if info is None:
         try:
             country = geolite2.lookup(ip).country
-            country_a = f", {country}" if ip_info and ip_info.location else country
-            country_b = f" ({country})"
         except:
-            country_a = country_b = ''
-        return '.'.join(ipc) + (f" ({ip_info.isp}, {ip_info.location}{country_a})" if ip_info else country_b)
-    
+            country = None
+        info = IPInfo(country)
+        ip_infos.set(ip, info)
+    return info
 
+def ip_country(ip):
+    '''
+    Country code of ip address (geolite2, cached in ip_infos), None if unknown
+    '''
+    return ip_info_get(ip).country
 
-async def get_device_js(device, columns):
+def mask_ip(ip, ip_info, country=None):
     '''
-    Prepare response for edit and view pages
+    Removes last octet from ip address. Adds isp, location (ip_info, see ip_lookup_many) and country
     '''
-    async with dba() as orm:
-        js = { k: await mask_ip(device.__dict__[k]) if k == 'ip' else device.__dict__[k] for k in columns }
-        events = await orm.scalars(select(Event).filter_by(device_id=device.id))
-        ecolumns = ('id', 'started', 'ended', 'downtime', 'old_ip', 'new_ip', 'comment', 'crossed')
-        js['events'] = []
-        for event in events:
-            js['events'].append({ k: await mask_ip(event.__dict__[k]) if k.endswith('_ip') else event.__dict__[k] for k in ecolumns })
-        return js
+    ipc = ip.split('.')
+    ipc[3] = '*'
+    if country:
+        country_a = f", {country}" if ip_info and ip_info.location else country
+        country_b = f" ({country})"
+    else:
+        country_a = country_b = ''
+    return '.'.join(ipc) + (f" ({ip_info.isp}, {ip_info.location}{country_a})" if ip_info else country_b)
+
+async def ip_infos_many(orm, ips):
+    '''
+    IPInfo objects of ip addresses, deduplicated and cached in ip_infos. Isp and location of the ones not cached yet
+    are searched in one query at most. Returns dict ip: IPInfo
+    '''
+    res = {}
+    for ip in ips:
+        if ip and ip not in res:
+            res[ip] = ip_info_get(ip)
+
+    missing = [ ip for ip, info in res.items() if info.masked is None ]
+    if missing:
+        rows = await ip_lookup_many(orm, missing)
+        for ip in missing:
+            info, row = res[ip], rows[ip]
+            if row:
+                info.isp, info.location = row.isp, row.location
+            info.masked = mask_ip(ip, row, info.country)
+    return res
+
+async def mask_ips(orm, ips):
+    '''
+    Masks ip addresses (see mask_ip) in one pass, cached in ip_infos. Returns dict ip: masked ip
+    '''
+    return { ip: info.masked for ip, info in (await ip_infos_many(orm, ips)).items() }
+
+def parse_time(s):
+    '''
+    Parses date time in ISO format (as returned by json_serial) to UTC without time zone, as stored in the database
+    Raises ValueError for incorrect or out of range values
+    '''
+    dt = datetime.fromisoformat(s)
+    if dt.tzinfo:
+        try:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            raise ValueError(s)
+    return dt
+
+def events_cursor(event):
+    '''
+    Keyset cursor for events pages: event ended (microseconds since epoch) and id
+    '''
+    return f"{(event.ended - datetime(1970, 1, 1)) // timedelta(microseconds=1)}_{event.id}"
+
+def events_cursor_parse(cursor):
+    '''
+    Event ended and id from events_cursor. Raises ValueError for incorrect or out of range values
+    '''
+    ended, id = cursor.split('_')
+    try:
+        ended = datetime(1970, 1, 1) + timedelta(microseconds=int(ended))
+    except OverflowError:
+        raise ValueError(cursor)
+    id = int(id)
+    if not 0 <= id < 2**31: raise ValueError(cursor)
+    return ended, id
+
+def events_query(device, args):
+    '''
+    Query for a page of device events, newest first, and page size. Request arguments (all optional):
+        since, until - time window for event ended, ISO format
+        before - cursor (more from previous page)
+        limit - page size, max EVENTS_PAGE_SIZE
+    Raises ValueError for incorrect arguments
+    '''
+    query = select(Event).filter_by(device_id=device.id)
+    if args.get('since'):
+        query = query.where(Event.ended >= parse_time(args.get('since')))
+    if args.get('until'):
+        query = query.where(Event.ended <= parse_time(args.get('until')))
+    if args.get('before'):
+        query = query.where(tuple_(Event.ended, Event.id) < tuple_(*events_cursor_parse(args.get('before'))))
+
+    limit = min(int(args.get('limit', EVENTS_PAGE_SIZE)), EVENTS_PAGE_SIZE)
+    if limit < 1: raise ValueError('Incorrect limit')
+    return query.order_by(Event.ended.desc(), Event.id.desc()).limit(limit + 1), limit
+
+EVENT_COLUMNS = ('id', 'started', 'ended', 'downtime', 'old_ip', 'new_ip', 'comment', 'crossed')
+
+async def get_device_js(orm, device, columns, page):
+    '''
+    Prepare response for edit and view pages. page - events query and limit, see events_query.
+    more - cursor for the next (older) page, or None
+    Uses the session that loaded the device: a second connection per request runs out the pool under load
+    '''
+    query, limit = page
+    events = (await orm.scalars(query)).all()
+    masked = await mask_ips(orm, [device.ip] + [ event.old_ip for event in events ] + [ event.new_ip for event in events ])
+
+    js = { k: masked.get(device.__dict__[k]) if k == 'ip' else device.__dict__[k] for k in columns }
+    js['updated'] = heartbeat_updated(device)
+    js['events'] = [ { k: masked.get(event.__dict__[k]) if k.endswith('_ip') else event.__dict__[k] for k in EVENT_COLUMNS } 
+        for event in events[:limit] ]
+    js['more'] = events_cursor(events[limit - 1]) if len(events) > limit else None
+    return js
 
 @app.get("/u/v/<token>")
 async def device_view(request, token):
     '''
     /u/v/<view_token or id for public devices> - device info and events list
     '''
+    res = cached_response(request)
+    if res: return res
+    generation = responses.generation
+
     async with dba() as orm:
         device = await orm.scalar(select(Device).filter_by(view_token=token))
         if not device and token.isdigit():
@@ -245,13 +1092,22 @@ async def device_view(request, token):
         columns = ('id', 'title', 'notes', 'country', 'location', 'isp', 'battery', 'reserve', 
             'battery_comment', 'reserve_comment', 'interval', 'created', 'ip', 'updated', 'downtime', 'downtime_uncrossed', 'version')
 
-        return json(await get_device_js(device, columns), default=json_serial)
+        try:
+            page = events_query(device, request.args)
+        except ValueError:
+            return json({'error': 'bad arguments'})
+
+        return cache_response(request, device.id, generation, await get_device_js(orm, device, columns, page))
 
 @app.get("/u/e/<token>")
 async def device_edit(request, token):
     '''
     /u/e/<edit_token> - device info for admin and events list
     '''
+    res = cached_response(request)
+    if res: return res
+    generation = responses.generation
+
     async with dba() as orm:
         device = await orm.scalar(select(Device).filter_by(edit_token=token))
         if not device:
@@ -261,7 +1117,276 @@ async def device_edit(request, token):
             'reserve_comment', 'public', 'interval', 'notify_interval',  'email', 'email_confirmed',  'notifyoff', 'notifyon', 
             'created', 'edit_token', 'view_token', 'update_token', 'ip', 'updated', 'downtime', 'downtime_uncrossed', 'version')
 
-        return json(await get_device_js(device, columns), default=json_serial)
+        try:
+            page = events_query(device, request.args)
+        except ValueError:
+            return json({'error': 'bad arguments'})
+
+        return cache_response(request, device.id, generation, await get_device_js(orm, device, columns, page))
+
+def day_segments(started, ended):
+    '''
+    Splits time range by days. Yields day (date), start and end (seconds since midnight)
+    '''
+    day = started.date()
+    while True:
+        midnight = datetime.combine(day, datetime.min.time())
+        end = min(ended, midnight + timedelta(days=1))
+        s = round((max(started, midnight) - midnight).total_seconds())
+        e = round((end - midnight).total_seconds())
+        if e > s:
+            yield day, s, e
+        if end >= ended:
+            break
+        day += timedelta(days=1)
+
+async def rollup_add(orm, device_id, event_id, started, ended, downtime):
+    '''
+    Adds downtime event to downtime_daily and downtime_prefix
+    '''
+    await orm.execute(PREFIX_ADD_SQL, {'device_id': device_id, 'event_id': event_id, 'started': started, 'ended': ended,
+        'downtime': downtime})
+    rows = [ {'device_id': device_id, 'day': day, 'down_seconds': e - s, 'crossed_seconds': 0, 'segments': [[s, e, event_id, False]]}
+        for day, s, e in day_segments(started, ended) ]
+    if not rows: return
+
+    stmt = pg_insert(DowntimeDaily).values(rows)
+    await orm.execute(stmt.on_conflict_do_update(index_elements=[DowntimeDaily.device_id, DowntimeDaily.day], set_={
+        'down_seconds': DowntimeDaily.down_seconds + stmt.excluded.down_seconds,
+        'segments': DowntimeDaily.segments.op('||')(stmt.excluded.segments)}))
+
+async def rollup_toogle(orm, event):
+    '''
+    Updates crossed state of event in downtime_daily and downtime_prefix
+    '''
+    await orm.execute(PREFIX_TOOGLE_SQL, {'device_id': event.device_id, 'ended': event.ended, 'event_id': event.id,
+        'crossed': bool(event.crossed)})
+    rows = await orm.scalars(select(DowntimeDaily).filter_by(device_id=event.device_id).where(
+        DowntimeDaily.day >= event.started.date(), DowntimeDaily.day <= event.ended.date()))
+    for row in rows:
+        segments = []
+        for s, e, event_id, crossed in row.segments:
+            if event_id == event.id and crossed != event.crossed:
+                crossed = event.crossed
+                row.down_seconds += (s - e) if crossed else (e - s)
+                row.crossed_seconds += (e - s) if crossed else (s - e)
+            segments.append([s, e, event_id, crossed])
+        row.segments = segments
+
+@app.get("/u/chart/<token>")
+async def device_chart(request, token):
+    '''
+    /u/chart/<view_token, edit_token or id for public devices> - downtime by days for the chart, from downtime_daily
+        tz - time zone offset in minutes (-Date.getTimezoneOffset()), days are local
+        since, until - first and last day (YYYY-MM-DD), device creation and today by default
+    Includes current downtime, if device is down now
+    '''
+    async with dba() as orm:
+        device = await orm.scalar(select(Device).where(or_(Device.view_token == token, Device.edit_token == token)))
+        if not device and token.isdigit():
+            device = await orm.scalar(select(Device).filter_by(id=int(token)).filter_by(public=True))
+
+        if not device:
+            return json({'error': 'bad token'})
+
+        now = datetime.utcnow()
+        try:
+            tz = int(request.args.get('tz', 0))
+            # UTC offsets are within a day
+            if abs(tz) > 1440: raise ValueError(tz)
+            tz = timedelta(minutes=tz)
+            since = date.fromisoformat(request.args.get('since')) if 'since' in request.args else (device.created + tz).date()
+            until = date.fromisoformat(request.args.get('until')) if 'until' in request.args else (now + tz).date()
+            since = max(since, until - timedelta(days=CHART_MAX_DAYS))
+        except (ValueError, OverflowError):
+            return json({'error': 'bad arguments'})
+
+        rows = await orm.scalars(select(DowntimeDaily).filter_by(device_id=device.id).where(
+            DowntimeDaily.day >= since - timedelta(days=1), DowntimeDaily.day <= until + timedelta(days=1)))
+        # Local start, local end, crossed, event id
+        segments = sorted( (datetime.combine(row.day, datetime.min.time()) + timedelta(seconds=s) + tz, 
+            datetime.combine(row.day, datetime.min.time()) + timedelta(seconds=e) + tz, crossed, event_id) 
+            for row in rows for s, e, event_id, crossed in row.segments )
+
+        updated = heartbeat_updated(device)
+        if updated and (now - updated).total_seconds() > device.interval * BLACKOUT_COEFFICIENT:
+            segments.append((updated + tz, now + tz, False, None))
+
+        # Join parts of events split by UTC midnight
+        joined = []
+        for segment in segments:
+            if joined and joined[-1][3] == segment[3] and joined[-1][1] == segment[0]:
+                joined[-1] = (joined[-1][0], segment[1], segment[2], segment[3])
+            else:
+                joined.append(segment)
+
+        days = {}
+        for started, ended, crossed, event_id in joined:
+            for day, s, e in day_segments(started, ended):
+                if day < since or day > until: continue
+                js = days.setdefault(day, {'down': 0, 'crossed': 0, 'ranges': []})
+                js['crossed' if crossed else 'down'] += e - s
+                js['ranges'].append([round(s / 3600, 3), round(e / 3600, 3), crossed])
+
+        res = []
+        day = since
+        while day <= until:
+            res.append({'day': day.isoformat(), **days.get(day, {'down': 0, 'crossed': 0, 'ranges': []})})
+            day += timedelta(days=1)
+        return json({'days': res})
+
+# For every window (device_id, since, until): totals of the last events ended before it starts and before it ends 
+# (selected by crossed), the first events ended in it and after it (may overlap its start or end), and the longest
+# outage in it. Index lookups on the downtime_prefix primary key, one range scan of outages in the window for longest
+SLA_SQL = sql('''
+SELECT w.n, COALESCE(b.outages, 0) - COALESCE(a.outages, 0) AS outages, 
+    COALESCE(b.downtime, 0) - COALESCE(a.downtime, 0) AS downtime, s.started AS s_started, s.ended AS s_ended, 
+    s.crossed AS s_crossed, u.started AS u_started, u.crossed AS u_crossed, l.longest
+FROM unnest(CAST(:ids AS integer[]), CAST(:sinces AS timestamp[]), CAST(:untils AS timestamp[])) 
+    WITH ORDINALITY AS w(device_id, since, until, n)
+LEFT JOIN LATERAL (
+    SELECT CASE WHEN :crossed THEN outages ELSE uncrossed_outages END AS outages,
+        CASE WHEN :crossed THEN downtime_sum ELSE uncrossed_sum END AS downtime
+    FROM downtime_prefix p WHERE p.device_id = w.device_id AND p.ended <= w.since 
+    ORDER BY p.ended DESC, p.event_id DESC LIMIT 1
+) AS a ON true
+LEFT JOIN LATERAL (
+    SELECT CASE WHEN :crossed THEN outages ELSE uncrossed_outages END AS outages,
+        CASE WHEN :crossed THEN downtime_sum ELSE uncrossed_sum END AS downtime
+    FROM downtime_prefix p WHERE p.device_id = w.device_id AND p.ended <= w.until 
+    ORDER BY p.ended DESC, p.event_id DESC LIMIT 1
+) AS b ON true
+LEFT JOIN LATERAL (
+    SELECT started, ended, crossed FROM downtime_prefix p WHERE p.device_id = w.device_id AND p.ended > w.since 
+    ORDER BY p.ended, p.event_id LIMIT 1
+) AS s ON true
+LEFT JOIN LATERAL (
+    SELECT started, crossed FROM downtime_prefix p WHERE p.device_id = w.device_id AND p.ended > w.until 
+    ORDER BY p.ended, p.event_id LIMIT 1
+) AS u ON true
+LEFT JOIN LATERAL (
+    SELECT MAX(EXTRACT(EPOCH FROM LEAST(p.ended, w.until) - GREATEST(p.started, w.since))) AS longest 
+    FROM downtime_prefix p WHERE p.device_id = w.device_id AND p.ended > w.since AND p.ended <= w.until 
+        AND (:crossed OR NOT p.crossed)
+) AS l ON true
+ORDER BY w.n
+''')
+
+@app.get("/u/sla")
+async def sla(request):
+    '''
+    /u/sla - uptime, downtime (seconds), number of outages and the longest one of many devices in time windows. Arguments:
+        tokens - comma separated view_token, edit_token or id for public devices, up to SLA_MAX_DEVICES
+        days - comma separated window lengths ending now, 7,30,90 by default, up to SLA_MAX_WINDOWS and SLA_MAX_DAYS
+        since, until - one custom window instead, ISO format (device creation and now by default)
+        crossed - 0 to exclude events crossed out by the user
+    Windows start no earlier than device creation. Outages overlapping window bounds are counted in part, 
+    current downtime is included if device is down now
+    '''
+    tokens = [ token for token in request.args.get('tokens', '').split(',') if token ][:SLA_MAX_DEVICES]
+    ids = [ int(token) for token in tokens if token.isdigit() ]
+    crossed = request.args.get('crossed') != '0'
+    now = datetime.utcnow()
+    try:
+        if request.args.get('since') or request.args.get('until'):
+            since = parse_time(request.args.get('since')) if request.args.get('since') else None
+            windows = [(since, min(parse_time(request.args.get('until')), now) if request.args.get('until') else now)]
+        else:
+            windows = [ (now - timedelta(days=min(int(days), SLA_MAX_DAYS)), now) 
+                for days in request.args.get('days', '7,30,90').split(',')[:SLA_MAX_WINDOWS] ]
+    except (ValueError, OverflowError):
+        return json({'error': 'bad arguments'})
+
+    async with engine.connect() as db:
+        devices = (await db.execute(select(Device.id, Device.created, Device.updated, Device.interval).where(or_(
+            Device.view_token.in_(tokens), Device.edit_token.in_(tokens), Device.id.in_(ids) & Device.public))
+            .order_by(Device.id))).all()
+        if not devices:
+            return json({'error': 'bad token'})
+
+        # Device, since, until
+        bounds = []
+        for device in devices:
+            created = device.created or now
+            for since, until in windows:
+                since = max(since, created) if since else created
+                bounds.append((device, min(since, until), until))
+        rows = (await db.execute(SLA_SQL, {'ids': [ device.id for device, since, until in bounds ],
+            'sinces': [ since for device, since, until in bounds ], 'untils': [ until for device, since, until in bounds ],
+            'crossed': crossed})).all()
+
+    res = {}
+    for (device, since, until), rs in zip(bounds, rows):
+        downtime, outages, longest = rs.downtime, rs.outages, float(rs.longest or 0)
+        # The first event ended in the window started before it
+        if rs.s_ended and rs.s_ended <= until and rs.s_started < since and (crossed or not rs.s_crossed):
+            downtime -= (since - rs.s_started).total_seconds()
+        # The first event ended after the window, and current downtime, up to the window end
+        updated = heartbeat_updated(device)
+        parts = [(rs.u_started, until)] if rs.u_started and (crossed or not rs.u_crossed) else []
+        if updated and (now - updated).total_seconds() > device.interval * BLACKOUT_COEFFICIENT:
+            parts.append((updated, min(now, until)))
+        for started, ended in parts:
+            seconds = (ended - max(started, since)).total_seconds()
+            if seconds > 0:
+                downtime += seconds
+                outages += 1
+                longest = max(longest, seconds)
+
+        seconds = (until - since).total_seconds()
+        downtime = min(max(round(downtime), 0), round(seconds))
+        res.setdefault(device.id, []).append({'since': since, 'until': until, 'downtime': downtime, 'outages': outages,
+            'longest': round(longest), 'uptime': round(100 - downtime * 100 / seconds, 4) if seconds > 0 else None})
+
+    return json({'devices': [ {'id': id, 'windows': items} for id, items in res.items() ]}, default=json_serial)
+
+@app.get("/u/export")
+async def export(request):
+    '''
+    /u/export - events of many devices, oldest first, streamed as they are read from the database. Arguments:
+        tokens - comma separated view_token, edit_token or id for public devices, up to EXPORT_MAX_DEVICES
+        format - ndjson (default) or csv
+        since, until - time window for event ended, ISO format
+    Rows have device_id and EVENT_COLUMNS, ip addresses are masked as on the device page
+    '''
+    tokens = [ token for token in request.args.get('tokens', '').split(',') if token ][:EXPORT_MAX_DEVICES]
+    fmt = request.args.get('format', 'ndjson')
+    ids = [ int(token) for token in tokens if token.isdigit() ]
+    try:
+        if fmt not in ('ndjson', 'csv'): raise ValueError(fmt)
+        window = []
+        if request.args.get('since'):
+            window.append(Event.ended >= parse_time(request.args.get('since')))
+        if request.args.get('until'):
+            window.append(Event.ended <= parse_time(request.args.get('until')))
+    except ValueError:
+        return json({'error': 'bad arguments'})
+
+    columns = ('device_id', *EVENT_COLUMNS)
+    async with engine.connect() as db:
+        devices = (await db.scalars(select(Device.id).where(or_(Device.view_token.in_(tokens), Device.edit_token.in_(tokens),
+            Device.id.in_(ids) & Device.public)).order_by(Device.id))).all()
+        if not devices:
+            return json({'error': 'bad token'})
+
+        response = await request.respond(content_type='application/x-ndjson' if fmt == 'ndjson' else 'text/csv',
+            headers={'Content-Disposition': f'attachment; filename="events.{fmt}"'})
+        if fmt == 'csv':
+            await response.send(','.join(columns) + '\r\n')
+
+        # Server side cursor, rows (not ORM objects) are not kept after the batch is sent
+        result = await db.stream(select(*[ getattr(Event, k) for k in columns ]).where(Event.device_id.in_(devices), 
+            *window).order_by(Event.device_id, Event.ended, Event.id).execution_options(yield_per=EVENTS_PAGE_SIZE))
+        async for rows in result.partitions():
+            masked = await mask_ips(db, [ row.old_ip for row in rows ] + [ row.new_ip for row in rows ])
+            rows = [ [ masked.get(v) if k.endswith('_ip') else v for k, v in zip(columns, row) ] for row in rows ]
+            if fmt == 'csv':
+                buf = io.StringIO()
+                csv.writer(buf).writerows([ json_serial(v) if isinstance(v, datetime) else v for v in row ] for row in rows)
+                await response.send(buf.getvalue())
+            else:
+                await response.send(''.join(dumps(dict(zip(columns, row)), default=json_serial) + '\n' for row in rows))
+        await response.eof()
 
 @app.post("/u/e/<token>")
 async def device_save(request, token):
@@ -276,6 +1401,7 @@ async def device_save(request, token):
         editable_columns = ['title', 'notes', 'location', 'isp', 'battery', 'reserve', 
           'battery_comment', 'reserve_comment', 'public', 'interval', 'notify_interval',  'email',  'notifyoff', 'notifyon']
 
+        was_public = device.public
         rj = request.json
         for col in editable_columns:
             if col in rj:
@@ -288,8 +1414,13 @@ async def device_save(request, token):
                 if col.endswith('interval'):
                     if val < MIN_INTERVAL or val > MAX_INTERVAL: return json({'alert': 'incorrect interval'})
                 setattr(device, col, val)
+        if 'interval' in rj:
+            # Refresh of too often responses
+            admission.heartbeats.pop(device.update_token)
 
-        notify_device(device)
+        notify_device(device, listing=was_public)
+        heartbeat_sync(device)
+        alerts_watch(device)
         await orm.commit()
 
         return json({'ok': True})
@@ -323,9 +1454,12 @@ async def email_send_code(request, token):
         device.email_vcode = str(random.randrange(100000, 999999))
         device.email_count += 1
 
-        asyncio.create_task(mailer.device_vcode(device.email, device.email_vcode, device.title, device.view_token, device.edit_token))
+        await outbox_add(orm, 'device_vcode', device.email, device.email_vcode, device.title, device.view_token, device.edit_token)
 
+        notify_device(device)
+        alerts_watch(device)
         await orm.commit()
+        outbox_wakeup()
 
         return json({'ok': True})
 
@@ -346,6 +1480,8 @@ async def verify_email(request, token):
         
         if device.email_vcode == rj['vcode']:
             device.email_confirmed = True
+            notify_device(device)
+            alerts_watch(device)
             js = {'ok': True}
         else:
             device.email_errors += 1
@@ -381,8 +1517,10 @@ async def change_token(request, token):
 
         rj = request.json
         tok = rj['tok']
+        admission.heartbeats.pop(device.update_token)
         new_token = await set_token(device, tok)
         notify_device(device)
+        heartbeat_sync(device)
         await orm.commit()
         return json({'ok': True, 'new_token': new_token})
 
@@ -399,6 +1537,8 @@ async def unsubscribe(request, token):
         device.email = ''
         device.email_confirmed = False
         res = 'You have successfully unsubscribed from notifications about ' + device.title
+        notify_device(device)
+        alerts_watch(device)
         await orm.commit()
         return text(res)
 
@@ -416,7 +1556,9 @@ async def toogle_event(request, token):
         event = await orm.scalar(select(Event).filter_by(id=int(rj['id'])).filter_by(device_id=device.id))
         event.crossed = not event.crossed
         device.downtime_uncrossed += event.downtime * (-1 if event.crossed else 1)
+        await rollup_toogle(orm, event)
         notify_device(device)
+        heartbeat_sync(device)
         await orm.commit()
         return json({'ok': True})
 
@@ -435,6 +1577,7 @@ async def add_comment(request, token):
         event.comment = rj['comment']
         notify_device(device)
         device.version += 1 
+        heartbeat_sync(device)
         await orm.commit()
         return json({'ok': True})
 
@@ -443,39 +1586,92 @@ async def create_device(request):
     '''
     Create new device
     '''
+    if not admission_register(request.remote_addr, 1):
+        return json({'blocked': True})
+
     async with dba() as orm:
-        now = datetime.utcnow()
-        yesterday = now - timedelta(days=1)
-        if await orm.scalar(select(func.count()).select_from(Device).where(
-            Device.ip == request.remote_addr, Device.created > yesterday)) > REG_PER_IP:
+        registered = await registrations(orm, request.remote_addr)
+        admission_counted(request.remote_addr, registered)
+        if registered > REG_PER_IP:
             return json({'blocked': True})
 
-        device = Device()
-        for tok in ('view', 'update', 'edit'):
-            token = await set_token(device, tok)
+        device, = await devices_insert(orm, request.remote_addr, 1)
+        admission_registered(request.remote_addr, 1)
+        return json({'ok': True, 'new_token': device.edit_token})
 
-    
-        device.created = now
+@app.post("/u/create_devices")
+async def create_devices(request):
+    '''
+    Creates many devices at once (provisioning). post - count, admin_key (optional)
+    Without ADMIN_KEY, limited by REG_PER_IP the same way as create_device.
+    Returns list of devices with id and tokens
+    '''
+    rj = request.json
+    count = rj.get('count')
+    if not isinstance(count, int) or count < 1 or count > REG_BULK_MAX:
+        return json({'error': 'bad arguments'})
 
-        device.ip = request.remote_addr
-        try:
-            device.country = geolite2.lookup(device.ip).country
-        except:
-            pass
+    admin_key = rj.get('admin_key')
+    limited = not (ADMIN_KEY and isinstance(admin_key, str) and hmac.compare_digest(admin_key, ADMIN_KEY))
+    if limited and not admission_register(request.remote_addr, count):
+        return json({'blocked': True})
 
-        if device.ip:
-            ip_int = int(IPv4Address(device.ip))
-            ip_info = await orm.scalar(select(IPs).filter(IPs.a <= ip_int, IPs.b >= ip_int))
-            if ip_info:
-                device.isp = ip_info.isp
-                device.location = ip_info.location + ' ' + device.country
+    async with dba() as orm:
+        if limited:
+            registered = await registrations(orm, request.remote_addr)
+            admission_counted(request.remote_addr, registered)
+            if registered + count - 1 > REG_PER_IP:
+                return json({'blocked': True})
 
-        orm.add(device)
-        await orm.commit()
-        device = await orm.scalar(select(Device).filter_by(edit_token=token))
-        device.title = 'Device ' + str(device.id)
-        await orm.commit()
-        return json({'ok': True, 'new_token': token})
+        rows = await devices_insert(orm, request.remote_addr, count)
+        admission_registered(request.remote_addr, count)
+        return json({'ok': True, 'devices': [ { k: getattr(row, k) for k in ('id', *DEVICE_TOKENS) } for row in rows ]})
+
+async def registrations(orm, ip):
+    '''
+    Number of devices registered from ip address in the last 24 hours
+    '''
+    yesterday = datetime.utcnow() - timedelta(days=1)
+    return await orm.scalar(select(func.count()).select_from(Device).where(Device.ip == ip, Device.created > yesterday))
+
+async def devices_insert(orm, ip, count):
+    '''
+    Creates count devices with random tokens and titles "Device <id>", in one INSERT, and commits. 
+    On token collision (unique indexes) retries with new tokens. Returns rows with id, tokens and update state
+    '''
+    now = datetime.utcnow()
+    values = {'created': now, 'ip': ip}
+    if ip:
+        info = (await ip_infos_many(orm, [ip]))[ip]
+        if info.country:
+            values['country'] = info.country
+        if info.isp is not None:
+            values['isp'] = info.isp
+            values['location'] = info.location + ' ' + values.get('country', '')
+
+    table = Device.__table__
+    for attempt in range(3):
+        tokens = func.unnest(*[ bindparam(tok, [ random_str() for n in range(count) ], type_=ARRAY(String)) 
+            for tok in DEVICE_TOKENS ]).table_valued(*DEVICE_TOKENS).render_derived()
+        # Ids are taken first, to make titles in the same statement
+        new = select(func.nextval('device_id_seq').label('id'), *tokens.c).cte('new_device')
+        stmt = table.insert().from_select(['id', 'title', *DEVICE_TOKENS, *values], 
+            select(new.c.id, literal('Device ') + cast(new.c.id, String), *[ new.c[tok] for tok in DEVICE_TOKENS ], 
+                *[ literal(v) for v in values.values() ])
+            ).returning(*[ table.c[k] for k in ('title', *Heartbeat.__slots__) ])
+        try:
+            rows = (await orm.execute(stmt)).all()
+            await orm.commit()
+            break
+        except IntegrityError:
+            await orm.rollback()
+            if attempt == 2: raise
+            print('Token collision, retrying')
+
+    for row in rows:
+        notify_device(row, listing=True)
+        heartbeat_sync(row)
+    return rows
 
 
 @app.post("/u/delete_device/<token>")
@@ -490,15 +1686,221 @@ async def delete_device(request, token):
 
         
         await orm.execute(delete(Event).where(Event.device_id == device.id))
+        await orm.execute(delete(DowntimeDaily).where(DowntimeDaily.device_id == device.id))
+        await orm.execute(delete(DowntimePrefix).where(DowntimePrefix.device_id == device.id))
+        await orm.execute(delete(EventsDaily).where(EventsDaily.device_id == device.id))
+        admission.heartbeats.pop(device.update_token)
         device.edit_token = device.view_token = device.update_token = None
+        notify_device(device, listing=True)
         device.email_confirmed = device.public = False
+        heartbeat_sync(device)
+        alerts_watch(device)
         await orm.commit()
         return json({'ok': True})
 
 class ws:
+    # target: set of Client
     subscriptions = {}
+    # client_key: Client
     sockets = {}
     asterisk_timestamp = 0
+    # Expiry wheel, all open sockets by last incoming message. second (time.monotonic, so clock changes
+    # don't reap them all at once): set of Client
+    buckets = {}
+    # Last second checked by ws_reaper_loop
+    reaped = int(time.monotonic())
+
+class Client:
+    '''
+    Web socket with its own writer task. Messages are put to a small queue (WEBSOCKET_QUEUE), so sending to
+    a slow client never delays others. Not sent refresh is not queued twice. 
+    A full queue is replaced with one refresh: the page reloads everything it missed
+    '''
+    def __init__(self, wsocket):
+        self.wsocket = wsocket
+        self.queue = asyncio.Queue(WEBSOCKET_QUEUE)
+        # Time of the last incoming message, and its bucket in ws.buckets
+        self.seen = self.bucket = None
+        self.touch()
+        self.refresh_queued = False
+        self.closed = False
+        # 1 - refresh messages only, 2 - deltas after alive messages (see watch)
+        self.protocol = 1
+        self.key = None
+        # Subscribed targets
+        self.targets = set()
+        self.writer = asyncio.create_task(self.write())
+
+    def touch(self, now=None):
+        '''
+        Sets last incoming message time (time.monotonic), moves the socket to its bucket
+        '''
+        self.seen = now or time.monotonic()
+        bucket = int(self.seen)
+        if bucket == self.bucket: return
+        ws_expiry_remove(self)
+        self.bucket = bucket
+        if bucket not in ws.buckets: ws.buckets[bucket] = set()
+        ws.buckets[bucket].add(self)
+
+    def send(self, msg):
+        '''
+        Queues message. Returns False if the socket is closed
+        '''
+        if self.closed: return False
+        if msg == 'refresh':
+            if self.refresh_queued: return True
+            self.refresh_queued = True
+        try:
+            self.queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            self.coalesce(msg)
+        return True
+
+    def coalesce(self, msg):
+        '''
+        Replaces queued messages and msg with one refresh. Refresh is also an answer to ping (.)
+        '''
+        dropped = self.queue.qsize() + (msg not in ('.', 'refresh'))
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait('refresh')
+        self.refresh_queued = True
+        metric_ws_dropped.inc(dropped)
+
+    async def write(self):
+        try:
+            while True:
+                msg = await self.queue.get()
+                if msg == 'refresh': self.refresh_queued = False
+                await asyncio.wait_for(self.wsocket.send(msg), WEBSOCKET_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except:
+            self.close()
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        if asyncio.current_task() is not self.writer:
+            self.writer.cancel()
+        asyncio.create_task(self.wsocket.close())
+
+def ws_subscribe(client, target):
+    if target in client.targets: return
+    client.targets.add(target)
+    if target not in ws.subscriptions: ws.subscriptions[target] = set()
+    ws.subscriptions[target].add(client)
+
+def ws_unsubscribe(client, target):
+    if target not in client.targets: return
+    client.targets.discard(target)
+    clients = ws.subscriptions[target]
+    clients.discard(client)
+    if not clients: del ws.subscriptions[target]
+
+def ws_clear(client):
+    '''
+    Removes all subscriptions of client, O(number of its targets)
+    '''
+    for target in list(client.targets):
+        ws_unsubscribe(client, target)
+
+def ws_expiry_remove(client):
+    clients = ws.buckets.get(client.bucket)
+    if clients is None: return
+    clients.discard(client)
+    if not clients: del ws.buckets[client.bucket]
+
+def ws_drop(client):
+    '''
+    Removes client from the registry, on disconnect
+    '''
+    ws_clear(client)
+    ws_expiry_remove(client)
+    if client.key and ws.sockets.get(client.key) is client:
+        del ws.sockets[client.key]
+
+def ws_reap(now):
+    '''
+    Closes and removes sockets without incoming messages for WEBSOCKET_TIMEOUT seconds. 
+    Checks every bucket once, so the cost is proportional to the number of reaped sockets
+    '''
+    limit = int(now - WEBSOCKET_TIMEOUT) - 1
+    reaped = 0
+    for bucket in range(ws.reaped + 1, limit + 1):
+        for client in list(ws.buckets.get(bucket, ())):
+            client.close()
+            ws_drop(client)
+            reaped += 1
+    ws.reaped = max(ws.reaped, limit)
+    return reaped
+
+async def ws_reaper_loop():
+    while True:
+        await asyncio.sleep(1)
+        try:
+            ws_reap(time.monotonic())
+        except:
+            traceback.print_exc()
+
+metrics.gauge('blackouts_ws_sockets', 'Open websockets', lambda: sum(len(clients) for clients in ws.buckets.values()))
+metrics.gauge('blackouts_ws_targets', 'Targets with subscribers (entries in ws.subscriptions)', lambda: len(ws.subscriptions))
+metrics.gauge('blackouts_ws_subscriptions', 'Subscriptions of all websockets', 
+    lambda: sum(len(clients) for clients in ws.subscriptions.values()))
+
+@app.on_request
+async def request_started(request):
+    request.ctx.started = time.perf_counter()
+    if SQL_TRACE:
+        request.ctx.sql = SQLTrace()
+        sql_trace.set(request.ctx.sql)
+
+@app.on_response
+async def request_finished(request, response):
+    '''
+    Records request time. With SQL_TRACE, adds X-SQL-Queries, X-SQL-Time (ms) and X-SQL-Sessions headers (query budgets
+    can be checked by tests), and prints requests with database time over SQL_TRACE_SLOW seconds
+    '''
+    if request.route and hasattr(request.ctx, 'started'):
+        metric_requests.labels(request.route.handler.__name__).observe(time.perf_counter() - request.ctx.started)
+
+    trace = getattr(request.ctx, 'sql', None)
+    if trace:
+        response.headers['X-SQL-Queries'] = str(trace.queries)
+        response.headers['X-SQL-Time'] = f'{trace.seconds * 1000:.1f}'
+        response.headers['X-SQL-Sessions'] = str(trace.sessions)
+        if trace.seconds > SQL_TRACE_SLOW:
+            print('SQL TRACE', request.method, request.path, trace.queries, 'queries', trace.sessions, 'sessions', 
+                f'{trace.seconds * 1000:.1f} ms')
+            for seconds, statement in sorted(trace.slowest, reverse=True):
+                print(f'    {seconds * 1000:.1f} ms', statement)
+
+@app.get("/u/metrics")
+async def metrics_text(request):
+    '''
+    /u/metrics - counters and latency histograms of this worker process, Prometheus text format
+    '''
+    return text(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.get("/u/stats")
+async def stats(request):
+    '''
+    /u/stats - sizes of in-memory structures of this worker process
+    '''
+    return json({
+        'pid': os.getpid(),
+        'sockets': sum(len(clients) for clients in ws.buckets.values()),
+        'client_keys': len(ws.sockets),
+        'targets': len(ws.subscriptions),
+        'subscriptions': sum(len(clients) for clients in ws.subscriptions.values()),
+        'expiry_buckets': len(ws.buckets),
+        'heartbeats': len(heartbeats.ids),
+        'alerts_heap': len(alerts.heap),
+        'alerts_watched': len(alerts.watched),
+        'responses_cached': len(responses.cached),
+        'ip_infos': len(ip_infos),
+    })
 
 @app.websocket("/u/watch")
 async def watch(request: Request, wsocket: Websocket):
@@ -506,93 +1908,263 @@ async def watch(request: Request, wsocket: Websocket):
     /u/watch - WebSocket handler
         Incoming message for creating / updating subscription: 
             resource_id@client_key
+            resource_id@client_key@2
 
             resource_id - may be device id, edit/view token, or * for all public devices
             client_key - random string 20 characters long
+            2 - protocol version, send deltas instead of refresh after alive messages
             
-            Only one subscription is allowed per socket
+            Replaces all subscriptions of the socket
             Only one socket is allowed per client_key
 
-        Any incoming messages without the @ symbol is treated as a keepalive
+        Incoming messages for more subscriptions on the same socket (up to WEBSOCKET_MAX_TARGETS):
+            +resource_id   subscribe
+            -resource_id   unsubscribe
+
+        Any other incoming messages is treated as a keepalive
 
         If no message has been received from the client within 50 seconds (WEBSOCKET_TIMEOUT), 
-        the socket is considered stale and will be purged when notify is called
+        the socket is considered stale and will be closed by ws_reaper_loop
 
         Outgoing message:
             .              for successful subscription or keepalive
             refresh        device(s) is updated
+            {"id": ...}    protocol 2 only, device is updated by alive message. Changed fields: updated, interval, 
+                           downtime, downtime_uncrossed, version. ip and new events (list) if there is a new event, 
+                           not for * subscribers. Client must reload if version is not increased by the number of events
 
     '''
-    target = None
-    key = None
-    async for msg in wsocket:
-        if len(msg) > 50:
-            wsocket.close()
-            continue
-
-        if '@' in msg:
-            target, key = msg.split('@')
-            if key in ws.sockets:
-                old_target = ws.sockets[key]
-                del ws.subscriptions[old_target][key]
-                if not ws.subscriptions[old_target]: del ws.subscriptions[old_target]
-
-            if target not in ws.subscriptions: ws.subscriptions[target] = {}
-            ws.subscriptions[target][key] = [wsocket, time.time()]
-            ws.sockets[key] = target
-        
-        await wsocket.send('.')
-        try:
-            ws.subscriptions[target][key][1] = time.time()
-        except:
-            pass
-
-async def notify(target):
+    client = Client(wsocket)
+    handled = metric_requests.labels('watch')
+    try:
+        async for msg in wsocket:
+            start = time.perf_counter()
+            if len(msg) > 50:
+                break
+
+            if '@' in msg:
+                target, key, *protocol = msg.split('@')
+                client.protocol = 2 if protocol == ['2'] else 1
+                old = ws.sockets.get(key)
+                if old and old is not client:
+                    ws_clear(old)
+                if client.key and client.key != key and ws.sockets.get(client.key) is client:
+                    del ws.sockets[client.key]
+                ws_clear(client)
+                ws_subscribe(client, target)
+                client.key = key
+                ws.sockets[key] = client
+            elif msg.startswith('+') and len(msg) > 1:
+                if len(client.targets) >= WEBSOCKET_MAX_TARGETS:
+                    break
+                ws_subscribe(client, msg[1:])
+            elif msg.startswith('-'):
+                ws_unsubscribe(client, msg[1:])
+
+            client.touch()
+            if not client.send('.'):
+                break
+            handled.observe(time.perf_counter() - start)
+    finally:
+        ws_drop(client)
+        client.close()
+
+def notify(target, delta=None):
     '''
-    Finds fresh web ws.sockets that are subscribed to the given target and sends a 'refresh' message to all of them
-    Cleans out stale and closed ws.sockets
-    For * target, allowed only once every 5 seconds (ASTERISK_MIN_TIME)
+    Queues a 'refresh' message to all web sockets that are subscribed to the given target,
+    or delta (see heartbeat_delta) to clients with protocol 2
+    Cleans out closed sockets
+    For * target, refresh is allowed only once every 5 seconds (ASTERISK_MIN_TIME), deltas are sent without ip and events
     '''
-    
+    start = time.perf_counter()
+    refresh = 'refresh'
     if target == '*':
-        if ws.asterisk_timestamp + ASTERISK_MIN_TIME > time.time(): return
-        ws.asterisk_timestamp = time.time()
-
-    staled = []
-    for key, (wsocket, t) in ws.subscriptions[target].items():
-        if t + WEBSOCKET_TIMEOUT < time.time():
-            staled.append(key)
+        if ws.asterisk_timestamp + ASTERISK_MIN_TIME > time.time(): 
+            refresh = None
         else:
-            try:
-                await wsocket.send('refresh')
-            except:
-                staled.append(key)
-    for key in staled:
-        del ws.subscriptions[target][key]
-        if not ws.subscriptions[target]: del ws.subscriptions[target]
-        del ws.sockets[key]
+            ws.asterisk_timestamp = time.time()
 
-def notify_device(device):
+    if delta:
+        delta = dumps({ k: v for k, v in delta.items() if target != '*' or k not in ('ip', 'events') }, default=json_serial)
+
+    staled = []
+    for client in ws.subscriptions[target]:
+        msg = delta if delta and client.protocol == 2 else refresh
+        if msg and not client.send(msg):
+            staled.append(client)
+    for client in staled:
+        client.close()
+        ws_drop(client)
+    metric_notify.observe(time.perf_counter() - start)
+
+def notify_device(device, listing=False, delta=None):
     '''
-    Calls notify in background for view_token and edit_token
-    For public devices, also calls for device id and *
+    Calls notify for view_token and edit_token
+    For public devices, also calls for device id and *. listing - for * anyway (device added, deleted or hidden)
+    Drops cached responses of the device (#id target) and listing (*)
+    delta - changes after alive message for protocol 2 clients, see heartbeat_delta
+    For a Device in a session transaction it's done after commit (notify_committed), so a page read before commit 
+    is not cached as a new one, and nothing is sent if the transaction is rolled back
     '''
     try:
-        targets = []
+        targets = ['#' + str(device.id)]
+        if device.public or listing:
+            targets.append('*')
         if device.public:
             targets.append(device.id)
-            targets.append('*')
 
         for token in (device.view_token, device.edit_token):
             if token: targets.append(token)
 
-        for target in targets:
-            target = str(target)
-            if target not in ws.subscriptions: continue
-            asyncio.create_task(notify(target))
+        targets = [ str(target) for target in targets ]
+        session = object_session(device) if isinstance(device, Device) else None
+        if session is not None and session.in_transaction():
+            session.info.setdefault('notify', []).append((targets, delta))
+        else:
+            notify_targets(targets, delta)
     except:
         traceback.print_exc()
 
+def notify_targets(targets, delta=None):
+    if PUBSUB or WORKERS > 1:
+        # Other processes drop cached responses after PUBSUB_TICK
+        responses_invalidate(int(targets[0][1:]))
+        if '*' in targets: responses_invalidate('*')
+        pubsub_publish(targets, delta)
+    else:
+        ws_dispatch(targets, delta)
+
+@event.listens_for(Session, 'after_commit')
+def notify_committed(session):
+    for targets, delta in session.info.pop('notify', []):
+        try:
+            notify_targets(targets, delta)
+        except:
+            traceback.print_exc()
+
+@event.listens_for(Session, 'after_transaction_end')
+def notify_discard(session, transaction):
+    # Rolled back (after_commit runs first)
+    if transaction.parent is None:
+        session.info.pop('notify', None)
+
+def ws_dispatch(targets, delta=None):
+    '''
+    Drops cached responses, calls notify for targets with subscribers in this process, updates down alert settings
+    '''
+    for target in targets:
+        if target.startswith('#'):
+            responses_invalidate(int(target[1:]))
+            continue
+        if target.startswith('!'):
+            # Down alert settings (alerts_watch in another process)
+            if delta:
+                alerts_set(int(target[1:]), delta['interval'], delta['updated'] and parse_time(delta['updated']), 
+                    delta['notified_down'])
+            continue
+        if target == '*':
+            responses_invalidate('*')
+        if target not in ws.subscriptions: continue
+        notify(target, delta)
+
+def heartbeat_delta(device, masked=None, event=None):
+    '''
+    Device fields changed by alive message, for protocol 2 clients (see watch). 
+    event - new event, masked - dict ip: masked ip with ips of device and event (see mask_ips)
+    '''
+    delta = { k: getattr(device, k) for k in ('id', 'updated', 'interval', 'downtime', 'downtime_uncrossed', 'version') 
+        if hasattr(device, k) }
+    if event:
+        delta['ip'] = masked.get(device.ip)
+        delta['events'] = [ { k: masked.get(getattr(event, k)) if k.endswith('_ip') else getattr(event, k) 
+            for k in EVENT_COLUMNS } ]
+    return delta
+
+def delta_merge(old, new):
+    '''
+    Joins deltas of the same device. None (refresh) if any of them is None
+    '''
+    if old is None or new is None: return None
+    events = old.get('events', []) + new.get('events', [])
+    merged = {**old, **new}
+    if events: merged['events'] = events
+    return merged
+
+PUBSUB_CHANNEL = 'blackouts_watch'
+
+class pubsub:
+    # Targets and merged delta to publish on the next tick. #id (or !id for alerts_watch): [targets, delta]
+    pending = {}
+    # Set when publish task is waiting for the tick
+    scheduled = False
+    # pubsub_listen_loop task
+    listener = None
+
+def pubsub_publish(targets, delta=None):
+    '''
+    Adds targets to be published on PUBSUB_CHANNEL. Targets are collected for PUBSUB_TICK seconds, 
+    so a burst of updates gives one NOTIFY per tick
+    '''
+    entry = pubsub.pending.get(targets[0])
+    if entry:
+        entry[0] = list(dict.fromkeys(entry[0] + targets))
+        entry[1] = delta_merge(entry[1], delta)
+    else:
+        pubsub.pending[targets[0]] = [targets, delta]
+    if not pubsub.scheduled:
+        pubsub.scheduled = True
+        asyncio.create_task(pubsub_flush())
+
+async def pubsub_flush():
+    await asyncio.sleep(PUBSUB_TICK)
+    pubsub.scheduled = False
+    entries = pubsub.pending
+    pubsub.pending = {}
+
+    # NOTIFY payload is limited to 8000 bytes. JSON list of [targets, delta], ascii only
+    payloads = [[]]
+    size = 0
+    for targets, delta in entries.values():
+        item = dumps([targets, delta], default=json_serial)
+        if len(item) > 7000:
+            item = dumps([targets, None])
+        if size + len(item) > 7000:
+            payloads.append([])
+            size = 0
+        payloads[-1].append(item)
+        size += len(item) + 1
+    payloads = [ '[' + ','.join(items) + ']' for items in payloads if items ]
+    try:
+        async with autocommit.connect() as db:
+            for payload in payloads:
+                await db.execute(sql('SELECT pg_notify(:channel, :payload)'), {'channel': PUBSUB_CHANNEL, 'payload': payload})
+    except:
+        traceback.print_exc()
+
+def pubsub_received(connection, pid, channel, payload):
+    for targets, delta in loads(payload):
+        ws_dispatch(targets, delta)
+
+async def pubsub_listen_loop():
+    '''
+    Listens PUBSUB_CHANNEL on a dedicated connection, reconnects if it is lost.
+    Every process gets all published targets, including its own
+    '''
+    while True:
+        try:
+            async with engine.connect() as db:
+                raw = await db.get_raw_connection()
+                await raw.driver_connection.add_listener(PUBSUB_CHANNEL, pubsub_received)
+                print('PUBSUB - listening')
+                while not raw.driver_connection.is_closed():
+                    await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            raise
+        except:
+            traceback.print_exc()
+        print('PUBSUB - connection lost')
+        await asyncio.sleep(1)
+
 @app.get("/u/uptime.macro")
 async def generate_macrodroid(request):
     '''
@@ -615,11 +2187,376 @@ async def generate_macrodroid(request):
 
     return res
 
+class Heartbeat:
+    '''
+    Update state of a device, kept in memory in cache mode (HEARTBEAT_MODE). 
+    Has the same attribute names as Device, so it can be passed to notify_device
+    '''
+    __slots__ = ('id', 'public', 'edit_token', 'view_token', 'update_token', 'ip', 'interval', 'updated', 'notified_down', 
+        'version')
+
+    def __init__(self, device):
+        for k in self.__slots__:
+            setattr(self, k, getattr(device, k))
+
+class heartbeats:
+    # update_token: Heartbeat
+    tokens = {}
+    # device id: Heartbeat
+    ids = {}
+    # Heartbeats with last update time not written to the database yet
+    dirty = set()
+
+async def heartbeat_warm():
+    '''
+    Load update state of all devices to memory
+    '''
+    async with dba() as orm:
+        devices = await orm.scalars(select(Device).where(Device.update_token != None).options(
+            load_only(*[ getattr(Device, k) for k in Heartbeat.__slots__ ])))
+        for device in devices:
+            heartbeat_sync(device)
+    print('HEARTBEAT - loaded', len(heartbeats.ids), 'devices')
+
+def heartbeat_sync(device):
+    '''
+    Replaces in-memory update state with device object. Must be called before commit, on every device change.
+    Keeps last update time if it's newer than in device object (not flushed yet)
+    '''
+    if HEARTBEAT_MODE != 'cache': return
+
+    old = heartbeats.ids.pop(device.id, None)
+    if old:
+        heartbeats.tokens.pop(old.update_token, None)
+        heartbeats.dirty.discard(old)
+
+    if not device.update_token: return
+
+    state = Heartbeat(device)
+    if old and old.updated and (not state.updated or old.updated > state.updated):
+        state.updated = old.updated
+        heartbeats.dirty.add(state)
+    heartbeats.ids[state.id] = state
+    heartbeats.tokens[state.update_token] = state
+
+def heartbeat_updated(device):
+    '''
+    Last update time of device, including not flushed updates
+    '''
+    state = heartbeats.ids.get(device.id)
+    if state and state.updated and (not device.updated or state.updated > device.updated):
+        return state.updated
+    return device.updated
+
+class admission:
+    # update_token: (last accepted alive message time, interval), in this process
+    heartbeats = LRU(ADMISSION_CACHE)
+    # ip address: [registrations (see registrations), time.monotonic when they were counted], in this process
+    registrations = LRU(ADMISSION_CACHE)
+
+def admission_accept(token, updated, interval):
+    admission.heartbeats.set(token, (updated, interval))
+
+def admission_heartbeat(token):
+    '''
+    Rejects alive message as too often before any database work, if this process accepted the token less than
+    MIN_INTERVAL / BLACKOUT_COEFFICIENT seconds ago. Same response as update. Returns None if the database is needed
+    '''
+    accepted = admission.heartbeats.get(token)
+    if not accepted: return None
+
+    updated, interval = accepted
+    delta = datetime.utcnow() - updated
+    seconds = delta.days * 86400 + delta.seconds
+    if seconds >= MIN_INTERVAL / BLACKOUT_COEFFICIENT:
+        admission.heartbeats.pop(token)
+        return None
+
+    metric_too_often.inc()
+    return text('too often', headers={'Refresh': str(interval - seconds)})
+
+def admission_register(ip, count):
+    '''
+    Returns False if count more devices from ip would exceed REG_PER_IP, by the number of registrations counted 
+    in the database less than REG_COUNT_CACHE seconds ago (and added since). True if the database is needed
+    '''
+    counted = admission.registrations.get(ip)
+    if not counted or time.monotonic() - counted[1] >= REG_COUNT_CACHE:
+        return True
+    return counted[0] + count - 1 <= REG_PER_IP
+
+def admission_counted(ip, registered):
+    '''
+    Saves the number of registrations from ip, counted in the database
+    '''
+    if REG_COUNT_CACHE:
+        admission.registrations.set(ip, [registered, time.monotonic()])
+
+def admission_registered(ip, count):
+    '''
+    Adds count committed registrations from ip to the saved number
+    '''
+    counted = admission.registrations.get(ip)
+    if counted:
+        counted[0] += count
+
+def heartbeat_cached(token, ip):
+    '''
+    Handles alive message in memory. 
+    Returns None if the database is needed: unknown token, first update, ip changed, downtime or down notification sent
+    '''
+    state = heartbeats.tokens.get(token)
+    if not state or not state.updated or state.ip != ip or state.notified_down:
+        return None
+
+    now = datetime.utcnow()
+    delta = (now - state.updated)
+    seconds = delta.days * 86400 + delta.seconds
+    if seconds < MIN_INTERVAL / BLACKOUT_COEFFICIENT:
+        metric_too_often.inc()
+        return text('too often', headers={'Refresh': str(state.interval - seconds)})
+
+    if seconds > state.interval * BLACKOUT_COEFFICIENT:
+        return None
+
+    state.updated = now
+    heartbeats.dirty.add(state)
+    alerts_schedule(state.id, now)
+    notify_device(state, delta=heartbeat_delta(state))
+    return text(str(seconds), headers={'Refresh': str(state.interval)})
+
+async def heartbeat_flush():
+    '''
+    Writes last update times from memory in one bulk UPDATE. Never moves updated column back
+    '''
+    if not heartbeats.dirty: return
+
+    states = heartbeats.dirty
+    heartbeats.dirty = set()
+    table = Device.__table__
+    try:
+        async with dba() as orm:
+            await orm.execute(table.update().where(table.c.id == bindparam('_id'), 
+                or_(table.c.updated == None, table.c.updated < bindparam('_updated'))).values(updated=bindparam('_updated')),
+                [ {'_id': state.id, '_updated': state.updated} for state in states ])
+            await orm.commit()
+    except:
+        # Retry on next flush, unless replaced by heartbeat_sync
+        heartbeats.dirty |= { state for state in states if heartbeats.ids.get(state.id) is state }
+        raise
+
+async def heartbeat_flush_loop():
+    '''
+    Writes last update times every HEARTBEAT_FLUSH_INTERVAL seconds
+    '''
+    while True:
+        await asyncio.sleep(HEARTBEAT_FLUSH_INTERVAL)
+        try:
+            await heartbeat_flush()
+        except:
+            traceback.print_exc()
+
+# Same logic as the database path of update, in one statement for a batch of alive messages (b, tokens must be unique). 
+# Locks the device rows in id order, so concurrent updates are serialized
+# d - device before update, c - device if update is not too often, u - device after update, e - new event
+# Downtime events also add device_up emails (o), downtime_daily (r, as rollup_add) and downtime_prefix (p) rows,
+# in the same statement, so they are never lost if the process stops after it
+HEARTBEAT_SQL = sql('''
+WITH b AS (
+    SELECT * FROM unnest(CAST(:tokens AS varchar[]), CAST(:ips AS varchar[]), CAST(:times AS timestamp[]), 
+        CAST(:countries AS varchar[])) WITH ORDINALITY AS b(token, ip, now, country, n)
+), d AS (
+    SELECT device.id, device.updated, device.ip, device.interval, b.token, b.ip AS new_ip, b.now, b.country,
+        GREATEST(COALESCE(NULLIF(device.interval, 0), :default_interval), :min_interval) AS new_interval,
+        FLOOR(EXTRACT(EPOCH FROM b.now - device.updated))::integer AS seconds
+    FROM b JOIN device ON device.update_token = b.token ORDER BY device.id FOR UPDATE OF device
+), c AS (
+    SELECT id, updated, ip, new_ip, now, country, new_interval, seconds,
+        CASE WHEN seconds > new_interval * CAST(:coefficient AS float8) THEN seconds END AS downtime,
+        updated IS NULL OR ip IS DISTINCT FROM new_ip AS ip_changed
+    FROM d WHERE updated IS NULL OR seconds >= CAST(:too_often AS float8)
+), u AS (
+    UPDATE device SET interval = c.new_interval, ip = c.new_ip, updated = c.now, 
+        notified_down = false, country = COALESCE(c.country, device.country),
+        created = CASE WHEN c.updated IS NULL THEN c.now ELSE device.created END,
+        downtime = device.downtime + COALESCE(c.downtime, 0),
+        downtime_uncrossed = device.downtime_uncrossed + COALESCE(c.downtime, 0),
+        version = device.version + CASE WHEN c.downtime IS NOT NULL OR c.ip_changed THEN 1 ELSE 0 END
+    FROM c WHERE device.id = c.id
+    RETURNING device.id, device.public, device.view_token, device.edit_token, device.email, device.email_confirmed, 
+        device.notifyon, device.title, device.version, device.downtime, device.downtime_uncrossed
+), e AS (
+    INSERT INTO events (started, ended, downtime, old_ip, new_ip, crossed, device_id)
+    SELECT c.updated, c.now, c.downtime, CASE WHEN c.ip_changed AND c.updated IS NOT NULL THEN c.ip END, 
+        CASE WHEN c.ip_changed THEN c.new_ip END, false, c.id
+    FROM c WHERE c.downtime IS NOT NULL OR c.ip_changed
+    RETURNING id, device_id
+), o AS (
+    INSERT INTO outbox (created, kind, email, args, status, attempts, next_attempt)
+    SELECT now() AT TIME ZONE 'utc', 'device_up', u.email, jsonb_build_array(u.title, u.edit_token), 'pending', 0, 
+        now() AT TIME ZONE 'utc'
+    FROM c JOIN u ON u.id = c.id WHERE c.downtime IS NOT NULL AND u.notifyon AND u.email_confirmed
+), r AS (
+    INSERT INTO downtime_daily (device_id, day, down_seconds, crossed_seconds, segments)
+    SELECT device_id, day, e - s, 0, jsonb_build_array(jsonb_build_array(s, e, id, false))
+    FROM (
+        SELECT e.device_id, e.id, d::date AS day,
+            ROUND(EXTRACT(EPOCH FROM GREATEST(c.updated, d) - d))::integer AS s,
+            ROUND(EXTRACT(EPOCH FROM LEAST(c.now, d + interval '1 day') - d))::integer AS e
+        FROM e JOIN c ON c.id = e.device_id, generate_series(date_trunc('day', c.updated), c.now, interval '1 day') AS d
+        WHERE c.downtime IS NOT NULL
+    ) AS segments
+    WHERE e > s
+    ON CONFLICT (device_id, day) DO UPDATE SET down_seconds = downtime_daily.down_seconds + excluded.down_seconds,
+        segments = downtime_daily.segments || excluded.segments
+), p AS (
+    INSERT INTO downtime_prefix (device_id, ended, event_id, started, downtime, crossed, outages, downtime_sum, 
+        uncrossed_outages, uncrossed_sum)
+    SELECT c.id, c.now, e.id, c.updated, c.downtime, false, COALESCE(l.outages, 0) + 1, 
+        COALESCE(l.downtime_sum, 0) + c.downtime, COALESCE(l.uncrossed_outages, 0) + 1, 
+        COALESCE(l.uncrossed_sum, 0) + c.downtime
+    FROM e JOIN c ON c.id = e.device_id LEFT JOIN LATERAL (
+        SELECT * FROM downtime_prefix WHERE device_id = c.id ORDER BY ended DESC, event_id DESC LIMIT 1
+    ) AS l ON true
+    WHERE c.downtime IS NOT NULL
+)
+SELECT b.token, b.ip AS new_ip, b.now, d.id AS device_id, d.interval, d.new_interval, d.seconds, d.updated, 
+    d.ip AS old_ip, c.downtime, c.ip_changed, u.id, u.public, u.view_token, u.edit_token, u.email, u.email_confirmed, 
+    u.notifyon, u.title, u.version, u.downtime AS total_downtime, u.downtime_uncrossed, e.id AS event_id
+FROM b LEFT JOIN d ON d.token = b.token LEFT JOIN c ON c.id = d.id LEFT JOIN u ON u.id = d.id 
+    LEFT JOIN e ON e.device_id = d.id
+ORDER BY b.n
+''')
+
+async def heartbeat_batch(beats):
+    '''
+    Handles alive messages with HEARTBEAT_SQL, one round trip to the database for all of them.
+    beats - list of (update_token, ip, time), tokens must be unique. Returns rows in the same order, see heartbeat_result
+    '''
+    if HEARTBEAT_MODE == 'cache':
+        # Downtime is calculated from the database
+        await heartbeat_flush()
+
+    countries = [ ip_country(ip) for token, ip, now in beats ]
+
+    async with autocommit.connect() as db:
+        rows = (await db.execute(HEARTBEAT_SQL, {'tokens': [ b[0] for b in beats ], 'ips': [ b[1] for b in beats ],
+            'times': [ b[2] for b in beats ], 'countries': countries, 
+            'default_interval': DEFAULT_INTERVAL, 'min_interval': MIN_INTERVAL, 'coefficient': BLACKOUT_COEFFICIENT,
+            'too_often': MIN_INTERVAL / BLACKOUT_COEFFICIENT})).all()
+
+        events = [ rs for rs in rows if rs.event_id ]
+        masked = await mask_ips(db, [ ip for rs in events for ip in (rs.new_ip, rs.old_ip) ]) if events else None
+
+    # device_up emails were added by the statement
+    if any(rs.downtime and rs.notifyon and rs.email_confirmed for rs in rows):
+        outbox_wakeup()
+
+    for rs in rows:
+        if rs.id is None: continue
+        admission_accept(rs.token, rs.now, rs.new_interval)
+        alerts_schedule(rs.id, rs.now)
+        device = SimpleNamespace(id=rs.id, updated=rs.now, interval=rs.new_interval, downtime=rs.total_downtime, 
+            downtime_uncrossed=rs.downtime_uncrossed, version=rs.version, ip=rs.new_ip)
+        event = None
+        if rs.event_id:
+            event = SimpleNamespace(id=rs.event_id, started=rs.updated, ended=rs.now, downtime=rs.downtime, 
+                old_ip=rs.old_ip if rs.ip_changed and rs.updated else None, new_ip=rs.new_ip if rs.ip_changed else None, 
+                comment=None, crossed=False)
+        # Row has the same attribute names as Device
+        notify_device(rs, delta=heartbeat_delta(device, masked, event))
+
+        state = heartbeats.ids.get(rs.id)
+        if state and (not state.updated or state.updated < rs.now):
+            state.updated, state.ip, state.interval, state.version = rs.now, rs.new_ip, rs.new_interval, rs.version
+            state.notified_down = False
+
+    return rows
+
+def heartbeat_result(rs):
+    '''
+    Response text and Refresh header (None if not set) of update for a row returned by heartbeat_batch
+    '''
+    if rs.device_id is None:
+        return 'bad token', None
+    if rs.id is None:
+        metric_too_often.inc()
+        return 'too often', rs.new_interval - rs.seconds
+    return str(rs.seconds) if rs.updated else '', rs.interval
+
+async def heartbeat_sql(token, ip):
+    '''
+    Handles alive message with HEARTBEAT_SQL, one round trip to the database (HEARTBEAT_MODE = "sql")
+    '''
+    res, refresh = heartbeat_result((await heartbeat_batch([(token, ip, datetime.utcnow())]))[0])
+    return text(res, headers={} if refresh is None else {'Refresh': str(refresh)})
+
+@app.post("/u/bulk")
+async def update_bulk(request):
+    '''
+    /u/bulk - Alive messages of many devices, for collectors that relay them. 
+    post - list of [update_token, ip, time], up to HEARTBEAT_BULK_MAX. ip - address of the device (collector address 
+    if null), time - unix timestamp when the message was received (now if null, not older than MAX_INTERVAL).
+    Returns list of [text, refresh] in the same order, as the response and Refresh header of /u/<update_token>.
+    Messages with the same token are handled in order of time, the first ones of each token in one statement, 
+    the second ones in the next, etc.
+    '''
+    rj = request.json
+    if not isinstance(rj, list) or len(rj) > HEARTBEAT_BULK_MAX:
+        return json({'error': 'bad arguments'})
+    metric_heartbeats.inc(len(rj))
+
+    now = datetime.utcnow()
+    res = [None] * len(rj)
+    beats = []
+    for n, item in enumerate(rj):
+        try:
+            token, ip, at = (list(item) + [None, None])[:3]
+            if not isinstance(token, str): raise ValueError(token)
+            ip = str(IPv4Address(ip)) if ip else request.remote_addr
+            at = min(datetime.utcfromtimestamp(at), now) if at else now
+        except:
+            res[n] = ['bad arguments', None]
+            continue
+        if at < now - timedelta(seconds=MAX_INTERVAL):
+            res[n] = ['bad time', None]
+            continue
+        beats.append((at, n, token, ip))
+
+    # rounds[k] - k-th messages of tokens, token: (index, ip, time)
+    rounds = []
+    for at, n, token, ip in sorted(beats):
+        for batch in rounds:
+            if token not in batch:
+                break
+        else:
+            batch = {}
+            rounds.append(batch)
+        batch[token] = (n, ip, at)
+
+    for batch in rounds:
+        rows = await heartbeat_batch([ (token, ip, at) for token, (n, ip, at) in batch.items() ])
+        for (n, ip, at), rs in zip(batch.values(), rows):
+            res[n] = heartbeat_result(rs)
+
+    return json(res)
+
 @app.get("/u/<token>")
 async def update(request, token):
     '''
     /u/<update_token> - Handles alive messages from users devices. 
     '''
+    metric_heartbeats.inc()
+    res = admission_heartbeat(token)
+    if res: return res
+
+    if HEARTBEAT_MODE == 'cache':
+        res = heartbeat_cached(token, request.remote_addr)
+        if res: return res
+
+    if HEARTBEAT_MODE == 'sql':
+        return await heartbeat_sql(token, request.remote_addr)
+
     async with dba() as orm:
         device = await orm.scalar(select(Device).filter_by(update_token=token))
         if not device:
@@ -629,24 +2566,29 @@ async def update(request, token):
         ip = request.remote_addr
         interval = device.interval
 
-        try:
-            device.country = geolite2.lookup(ip).country
-        except:
-            pass
+        if device.ip != ip:
+            # Country is looked up only for a new ip, and not assigned if the same
+            country = ip_country(ip)
+            if country and country != device.country:
+                device.country = country
 
         if not device.interval: device.interval = DEFAULT_INTERVAL
         if device.interval < MIN_INTERVAL: device.interval = MIN_INTERVAL
         
 
+        # Including last update not flushed yet (HEARTBEAT_MODE="cache")
+        updated = heartbeat_updated(device)
         event = Event()
         event.ended = now
-        event.started = device.updated
+        event.started = updated
+        mail = False
 
-        if device.updated:
-            delta = (now - device.updated)
+        if updated:
+            delta = (now - updated)
             # Yes, timedelta objects in python will give you a lot of fun if you expect the same behavior as in javascript.
             seconds = delta.days * 86400 + delta.seconds
             if seconds < MIN_INTERVAL / BLACKOUT_COEFFICIENT:
+                metric_too_often.inc()
                 return text('too often', headers={'Refresh': str(device.interval - seconds)})
 
             if seconds > device.interval * BLACKOUT_COEFFICIENT:
@@ -656,7 +2598,8 @@ async def update(request, token):
                 device.downtime_uncrossed += seconds
 
                 if device.notifyon and device.email_confirmed:
-                    asyncio.create_task(mailer.device_up(device.email, device.title, device.edit_token))
+                    await outbox_add(orm, 'device_up', device.email, device.title, device.edit_token)
+                    mail = True
 
         else:
             # New device. Set created (registered) date time and write first event without old_ip
@@ -671,6 +2614,10 @@ async def update(request, token):
             event.device = device
             orm.add(event)
             device.version += 1 
+            await orm.flush()
+
+        if event.downtime:
+            await rollup_add(orm, device.id, event.id, event.started, event.ended, event.downtime)
 
         device.ip = ip
         device.updated = now
@@ -678,9 +2625,19 @@ async def update(request, token):
         if device.notified_down:
             device.notified_down = False
 
-        notify_device(device)
+        accepted = (now, device.interval)
+        alerts_schedule(device.id, now)
+        if event.id:
+            delta = heartbeat_delta(device, await mask_ips(orm, [ip, event.old_ip]), event)
+        else:
+            delta = heartbeat_delta(device)
+        notify_device(device, delta=delta)
+        heartbeat_sync(device)
 
         await orm.commit()
+        admission_accept(token, *accepted)
+        if mail:
+            outbox_wakeup()
 
         try:
             ret = str(seconds)
@@ -708,11 +2665,19 @@ async def add_ip(ip, isp, location):
         ip_info.location = location
         orm.add(ip_info)
         await orm.commit()
+
+    if IPS_INDEX == 'memory':
+        await ips_index.load()
+    ip_infos.clear()
+    responses_clear()
     
 
 if __name__ == '__main__':
+    if WORKERS > 1 and HEARTBEAT_MODE == 'cache':
+        raise ValueError('HEARTBEAT_MODE="cache" works with one worker only')
+
     hp = SANIC_SOCKET.split(':')
     if hp[0] == 'unix':
-        app.run(unix=hp[1], access_log=False)
+        app.run(unix=hp[1], access_log=False, workers=WORKERS)
     else:
-        app.run(host=hp[0], port=int(hp[1]), access_log=False)
\ No newline at end of file
+        app.run(host=hp[0], port=int(hp[1]), access_log=False, workers=WORKERS)
\ No newline at end of file
@@ -18,12 +18,63 @@
 
 from email.message import EmailMessage
 import aiosmtplib
+import asyncio
+import time
 
 from CONFIG import *
+import metrics
+
+class pool:
+	# Connected and authenticated SMTP clients, not used at the moment
+	idle = []
+	# Limits the number of connections and messages sent at once (MAILER_POOL_SIZE)
+	semaphore = None
+
+async def smtp_connect():
+	smtp = aiosmtplib.SMTP(hostname=MAILER_SERVER, port=MAILER_PORT or None, username=MAILER_USERNAME or None, 
+		password=MAILER_PASSWORD or None, use_tls=MAILER_TLS)
+	await smtp.connect()
+	return smtp
 
 async def send_smtp(message):
-	await aiosmtplib.send(message, hostname=MAILER_SERVER, username=MAILER_USERNAME, 
-		password=MAILER_PASSWORD, use_tls=MAILER_TLS)
+	'''
+	Sends message over a pooled connection, waits for a free one if MAILER_POOL_SIZE messages are being sent.
+	A connection closed by the server while idle is replaced once, any other error closes the connection
+	'''
+	if not pool.semaphore:
+		pool.semaphore = asyncio.Semaphore(MAILER_POOL_SIZE)
+
+	async with pool.semaphore:
+		smtp = pool.idle.pop() if pool.idle else None
+		try:
+			if smtp and smtp.is_connected:
+				try:
+					await smtp.send_message(message)
+				except (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError, ConnectionError):
+					smtp.close()
+					smtp = None
+			else:
+				smtp = None
+
+			if not smtp:
+				smtp = await smtp_connect()
+				await smtp.send_message(message)
+		except:
+			if smtp: smtp.close()
+			raise
+		pool.idle.append(smtp)
+
+async def close():
+	'''
+	Closes idle connections, on shutdown
+	'''
+	idle = pool.idle
+	pool.idle = []
+	for smtp in idle:
+		try:
+			await smtp.quit()
+		except:
+			smtp.close()
 
 async def send_message(email, subject, content):
 	message = EmailMessage()
@@ -35,12 +86,17 @@ async def send_message(email, subject, content):
 	
 	if email.endswith('@example.com'):
 		from json import dumps
-		import time
 		open('example_email.log', 'a').write(dumps({'timestamp': time.time(), 'from': message["From"], 'to': message["To"], 
 					 'subject': message["Subject"], 'content': content})+'\n')
 		return
 	
-	await send_smtp(message)
+	start = time.perf_counter()
+	try:
+		await send_smtp(message)
+	except:
+		metrics.mailer_failures.inc()
+		raise
+	metrics.mailer_seconds.observe(time.perf_counter() - start)
 
 def footer(email, edit_token):
 	return (f'<br><br><big><a href="{MAILER_URL}/e/{edit_token}">Change settings</a></big><br><br><br>' +
@@ -0,0 +1,112 @@
+# Blackouts@HomServ - uptime monitoring service for home internet connection
+# Copyright (C) 2022 Oleksandr Titarenko <admin@homserv.net>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Counters and latency histograms in Prometheus text format (/u/metrics), per worker process.
+# Everything runs in one event loop thread, so recording is a plain increment without locks.
+# Labeled series are created on first use and reused, hot paths should get them once (see Family.labels)
+
+from bisect import bisect_left
+
+# Upper bounds of histogram buckets (seconds)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+families = []
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        # Last one is +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+class Family:
+    '''
+    Metric with one optional label. kind - counter, histogram or gauge.
+    Gauges are read at render time from callback, which returns a number, or dict label value: number
+    '''
+    def __init__(self, name, help, kind, label=None, callback=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label = label
+        self.callback = callback
+        # label value (None without label): Counter or Histogram
+        self.children = {}
+        families.append(self)
+
+    def labels(self, value=None):
+        child = self.children.get(value)
+        if child is None:
+            child = self.children[value] = Histogram() if self.kind == 'histogram' else Counter()
+        return child
+
+    def series(self, suffix, value, extra=''):
+        labels = [ f'{self.label}="{value}"' ] if self.label and value is not None else []
+        if extra: labels.append(extra)
+        return f"{self.name}{suffix}{{{','.join(labels)}}}" if labels else self.name + suffix
+
+    def render(self):
+        lines = [ f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}' ]
+        if self.kind == 'gauge':
+            values = self.callback()
+            for value, number in (values.items() if isinstance(values, dict) else [(None, values)]):
+                lines.append(f'{self.series("", value)} {number}')
+        elif self.kind == 'counter':
+            for value, child in self.children.items():
+                lines.append(f'{self.series("_total", value)} {child.value}')
+        else:
+            for value, child in self.children.items():
+                total = 0
+                for le, count in zip(BUCKETS + ('+Inf',), child.counts):
+                    total += count
+                    bucket = f'le="{le}"'
+                    lines.append(f'{self.series("_bucket", value, bucket)} {total}')
+                lines.append(f'{self.series("_sum", value)} {child.sum}')
+                lines.append(f'{self.series("_count", value)} {total}')
+        return lines
+
+def counter(name, help, label=None):
+    return Family(name, help, 'counter', label)
+
+def histogram(name, help, label=None):
+    return Family(name, help, 'histogram', label)
+
+def gauge(name, help, callback, label=None):
+    return Family(name, help, 'gauge', label, callback)
+
+def render():
+    '''
+    All metrics in Prometheus text exposition format
+    '''
+    return '\n'.join(line for family in families for line in family.render()) + '\n'
+
+# Mailer, recorded in mailer.send_message
+mailer_seconds = histogram('blackouts_mailer_send_seconds', 'Sending one email over SMTP').labels()
+mailer_failures = counter('blackouts_mailer_failures', 'Emails not sent because of an error').labels()
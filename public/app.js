@@ -71,11 +71,19 @@ const Index = {
     async refresh() {
       this.listing = await request("/u/listing")
       loaded()
+    },
+    applyDelta(delta) {
+      var device = (this.listing.devices || []).find(device => device.id == delta.id)
+      if (!device) {
+        return false
+      }
+      Object.assign(device, delta)
+      return true
     }
   },
   mounted() {
     this.refresh()
-    ws_start('*', this.refresh)
+    ws_start('*', this.refresh, this.applyDelta)
   }
 }
 
@@ -112,15 +120,16 @@ const DeviceView = {
       <hr>
       <device-info :device="device"></device-info>
       </b-container>
-      <downtime-chart :events="device_cached.events"></downtime-chart>
+      <downtime-chart :token="$route.params.token" :device="device_cached"></downtime-chart>
       <h3>Downtimes list</h3>
-      <downtime-table :device="device_cached"></downtime-table>
+      <downtime-table :device="device_cached" @older="loadOlder"></downtime-table>
       <welcome></welcome>
     </div>`,
   data() {
     return {
       device: {},
       device_cached: {},
+      older: {events: [], more: null}
     }
   },
   methods: {
@@ -129,11 +138,17 @@ const DeviceView = {
       prepare_device.apply(this)
       document.title = `${this.device.title} - ${APP_TITLE}`
       loaded()
+    },
+    loadOlder() {
+      load_older.apply(this, ["/u/v/" + this.$route.params.token])
+    },
+    applyDelta(delta) {
+      return apply_delta.apply(this, [delta])
     }
   },
   mounted() {
     this.refresh()
-    ws_start(this.$route.params.token, this.refresh)
+    ws_start(this.$route.params.token, this.refresh, this.applyDelta)
   }
 }
 
@@ -19,7 +19,8 @@
 // On error, show message and for get only retry every 2 seconds max 30 times
 async function request(uri, post_data=null) {
   var tries = 30
-  var options = {cache: "no-store"}
+  // Revalidate with ETag, unchanged response is 304 and taken from browser cache
+  var options = {cache: "no-cache"}
   if (post_data) {
     tries = 1
     options.method = 'POST'
@@ -69,6 +70,12 @@ function prepare_device() {
     // Cache is updated if device is down now or corrected downtime or version is changed
     if (is_blackout_now || this.device.downtime_uncrossed != this.device_cached.downtime_uncrossed || 
       this.device.version != this.device_cached.version) {
+      // Server returns only recent events (page), add older pages loaded by load_older
+      if (this.older.events.length) {
+        var ids = new Set(this.device.events.map(event => event.id))
+        this.device.events = this.device.events.concat(this.older.events.filter(event => !ids.has(event.id)))
+        this.device.more = this.older.more
+      }
       this.device_cached = this.device
       this.device_cached.events = this.device.events.sort((x,y) => {
         return x.id - y.id
@@ -94,6 +101,32 @@ function prepare_device() {
     }
 }
 
+// Apply changed device fields from WebSocket (see ws_start). Returns false if device must be reloaded:
+// another device or missed changes (version is increased once per event)
+function apply_delta(delta) {
+  var events = delta.events || []
+  if (delta.id != this.device.id || delta.version != this.device.version + events.length) {
+    return false
+  }
+  var device = Object.assign({}, this.device, delta)
+  // Event without id (currently offline) is added by prepare_device
+  device.events = this.device.events.filter(event => event.id).concat(events)
+  this.device = device
+  prepare_device.apply(this)
+  return true
+}
+
+// Load next page of older events. uri - /u/v/<token> or /u/e/<token>
+async function load_older(uri) {
+  var page = await request(uri + '?before=' + this.device_cached.more)
+  this.older.events = this.older.events.concat(page.events)
+  this.older.more = page.more
+  // Remove event for currently offline device, it will be added again. And force cache update
+  this.device.events = this.device.events.filter(event => event.id)
+  this.device_cached = {}
+  prepare_device.apply(this)
+}
+
 const deviceMixin = {
   computed: {
     timed () {
@@ -153,7 +186,7 @@ const deviceMixin = {
 
 Vue.component('downtime-table', {
   props: ['device', 'edit'],
-  template: `<b-table :items="events" :fields="fields" dark stacked="md">
+  template: `<div><b-table :items="events" :fields="fields" dark stacked="md">
     <template #cell(started)="data">
       <span v-if="edit && data.item.id">
         <b-icon :icon="data.item.crossed ? 'x-circle' : 'bookmark-x-fill'" class="clickable" @click="toogle(data.item.id)"></b-icon>
@@ -174,7 +207,9 @@ Vue.component('downtime-table', {
       <span v-if="!data.item.started && data.item.new_ip">Device registered<br>IP <i>{{ data.item.new_ip }}</i><br></span>
       <span v-if="data.item.comment" class="ecomment">{{ data.item.comment }}</span>
     </template>
-  </b-table>`,
+  </b-table>
+  <b-button block v-if="device.more" @click="$emit('older')">Load older events</b-button>
+  </div>`,
   data() {
     return {
       events: [],
@@ -503,15 +538,16 @@ const DeviceEdit = {
       </b-form>
       </b-container>
       
-      <downtime-chart :events="device_cached.events"></downtime-chart>
+      <downtime-chart :token="$route.params.token" :device="device_cached"></downtime-chart>
       <h3>Downtimes list</h3>
-      <downtime-table :device="device_cached" :edit="device.edit_token"></downtime-table>
+      <downtime-table :device="device_cached" :edit="device.edit_token" @older="loadOlder"></downtime-table>
       <a href="" @click.prevent="deleteDevice" class="dellink">Delete device</a>
     </div>`,
   data() {
     return {
       device: {},
       device_cached: {},
+      older: {events: [], more: null},
       editable: {reset: true},
       editable_initial: '',
       configured_email: '',
@@ -695,9 +731,16 @@ const DeviceEdit = {
         app.logosClick()
       }
     },
+    loadOlder() {
+      load_older.apply(this, ["/u/e/" + this.$route.params.token])
+    },
+    applyDelta(delta) {
+      return apply_delta.apply(this, [delta])
+    },
     async start() {
+      this.older = {events: [], more: null}
       this.refresh()
-      ws_start(this.$route.params.token, this.refresh)
+      ws_start(this.$route.params.token, this.refresh, this.applyDelta)
     }
   },
   computed: {
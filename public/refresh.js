@@ -41,6 +41,10 @@ ws_global_refresh = null
 ws_global_refresh = () => {
   console.log('Nothing to refresh')
 }
+// Currect delta callback, if set, subscribing with protocol 2. Returns false if delta can't be applied
+ws_global_apply = null
+// Additional resource ids on the same socket (ws_add)
+ws_extra = new Set()
 
 // The client key is used for server side optimization. Only one socket is allowed per key. We could store this in cookies 
 // or sessionStorage, but this will not work correctly if multiple copies of the application are open in different windows/tabs.
@@ -52,11 +56,18 @@ ws_now = ''
 
 // resource_id (ws_subscribe) - may be device id, edit/view token, or * for all devices
 // callback (ws_global_refresh) - called when device is updated or by timer
-function ws_start(resource_id=null, callback=null) {
-  if (resource_id) { ws_subscribe = resource_id }
-  if (callback) { ws_global_refresh = callback }
+// apply (ws_global_apply) - called with changed device fields after alive message, instead of callback
+function ws_start(resource_id=null, callback=null, apply=null) {
+  if (resource_id) {
+    ws_subscribe = resource_id
+    ws_extra.clear()
+  }
+  if (callback) {
+    ws_global_refresh = callback
+    ws_global_apply = apply
+  }
   
-  var cmd = ws_subscribe + '@' + ws_socket_key
+  var cmd = ws_subscribe + '@' + ws_socket_key + (ws_global_apply ? '@2' : '')
 
   if (ws_socket && ws_timestamp + ws_timeout >= new Date()) {
     try {
@@ -82,12 +93,19 @@ function ws_start(resource_id=null, callback=null) {
       console.log('connected to ', ws_url)
       ws_socket.send(cmd)
       console.log('subscribed to ', cmd)
+      ws_extra.forEach(resource_id => ws_socket.send('+' + resource_id))
     }
   }
   ws_socket.onmessage = (event) => {
     if (event.data == 'refresh') {
       console.log('refresh by WebSocket')
       ws_global_refresh()
+    } else if (event.data[0] == '{') {
+      var delta = JSON.parse(event.data)
+      if (!ws_global_apply || !ws_global_apply(delta)) {
+        console.log('refresh by WebSocket, delta not applied')
+        ws_global_refresh()
+      }
     }
     // keepalive - set timestamp
     ws_timestamp = +new Date()
@@ -100,6 +118,22 @@ function ws_start(resource_id=null, callback=null) {
   }
 }
 
+// Subscribe to one more resource_id on the same socket, callbacks are the same as in ws_start.
+// Messages with protocol 2 have device id. Subscriptions are reset by ws_start with resource_id
+function ws_add(resource_id) {
+  ws_extra.add(resource_id)
+  try {
+    ws_socket.send('+' + resource_id)
+  } catch {}
+}
+
+function ws_remove(resource_id) {
+  ws_extra.delete(resource_id)
+  try {
+    ws_socket.send('-' + resource_id)
+  } catch {}
+}
+
 // Every ws_check_interval
 setInterval(() => {
   try {
@@ -15,11 +15,15 @@
 // along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 Vue.component('downtime-chart', {
-  props: ['events'],
+  // token - view/edit token or id, device - reloaded when changed
+  props: ['token', 'device'],
   template: `<div class="vchart"><div class="chart"><canvas id="myChart"></canvas></div></div>`,
   watch: {
-    events (events) {
-      // Assumes events is sorted by datetime
+    async device (device) {
+      if (!device.id) { return }
+      // Days are calculated on the server, in local timezone. Current downtime is included
+      var tz_offset = -(new Date().getTimezoneOffset())
+      var chart = await request(`/u/chart/${this.token}?tz=${tz_offset}`)
       var xAxes = []
       var datasets = []
 
@@ -51,84 +55,18 @@ Vue.component('downtime-chart', {
         }
       }
 
-      
-      // Start from device creation date at 00:00:00 o'clock in local timezone
-      var current = new Date(events[0].ended)
-      current.setHours(0)
-      current.setMinutes(0)
-      current.setSeconds(0)
-      // Carry flag - if was offline on midnight
-      var night = false
-      // Event index
-      var n = 1
-      // Current date time
-      var now = new Date()
-      // [day_number] date in locale format
-      var days = []
+      // [day_number] date in locale format. Date without time is parsed as UTC, so add time to get local midnight
+      var days = chart.days.map(day => new Date(day.day + 'T00:00:00').toLocaleDateString())
       // [day_number][event_number][0: start_hour, 1: end_hour, 2: is_crossed]
-      var all_ranges = []
+      var all_ranges = chart.days.map(day => day.ranges)
       // [day_number] tooltip text
-      var downtimes_texts = []
-      while (current <= now) {
-        var tomorrow = new Date(+current + 86400000)
-        // DST sucks
-        if (tomorrow.getHours() == 23) {
-          tomorrow = new Date(+tomorrow + 3600000)
-          console.log(tomorrow, 'DST end')
-        }
-        if (tomorrow.getHours() == 1) {
-          tomorrow = new Date(+tomorrow - 3600000)
-          console.log(tomorrow, 'DST start')
+      var downtimes_texts = chart.days.map(day => {
+        var ltext = ` ${formatSeconds(day.down)} down`
+        if (day.crossed) {
+          ltext += ` ( + ${ formatSeconds(day.crossed)} excluded)`
         }
-        var downtime = 0
-        var downtime_excluded = 0
-        var ranges = []
-
-        while (events[n]) {
-          // We don't want events about ip change here
-          if (events[n].downtime) {
-            var started = new Date(events[n].started)
-            var ended = new Date(events[n].ended)
-            // End of the day reached, push data
-            if (started >= tomorrow) { break }
-            // Started at 0 o'clock
-            if (night) { started = current }
-            if (ended > tomorrow) {
-              night = true
-              if (!events[n].crossed) {
-                downtime += tomorrow - started
-              } else {
-                downtime_excluded += tomorrow - started
-              }
-              // Ended at 24 o'clock
-              ranges.push([started.getHours() + started.getMinutes() / 60, 24, events[n].crossed])
-
-              
-              break
-            } else {
-              night = false
-              if (!events[n].crossed) {
-                downtime += ended - started
-              } else {
-                downtime_excluded += ended - started
-              }
-              ranges.push([started.getHours() + started.getMinutes() / 60, 
-                ended.getHours() + ended.getMinutes() / 60, events[n].crossed])
-              
-            }
-          }
-          n ++
-        }
-        // Push data for this day
-        days.push(current.toLocaleDateString())
-        all_ranges.push(ranges)
-        var ltext = ` ${formatSeconds(downtime / 1000)} down`
-        if (downtime_excluded ) {
-          ltext += ` ( + ${ formatSeconds(downtime_excluded / 1000)} excluded)`
-        }
-        downtimes_texts.push(ltext)
-        current = tomorrow
-      }
+        return ltext
+      })
 
       // Now all data are in all_ranges
       // But we must turn it inside out
@@ -1,16 +1,19 @@
 # Execute (from ~/blackouts directory): env/bin/python -m unittest tests.backend
 import unittest
+import asyncio
 import sys
 import socket
 from time import time, sleep
 from json import loads, dumps
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from random import SystemRandom
 from http.client import HTTPConnection
+from websockets.sync.client import connect as ws_connect, unix_connect as ws_unix_connect
 
 sys.path.append('.')
 
 from CONFIG import *
+import blackouts as tgt
 
 random = SystemRandom()
 r1 = random.randrange(0, 256)
@@ -35,6 +38,13 @@ def get_cl():
     else:
         return HTTPConnection(hp[0], int(hp[1]))
 
+def get_ws():
+    hp = SANIC_SOCKET.split(':')
+    if hp[0] == 'unix':
+        return ws_unix_connect(hp[1], 'ws://localhost/u/watch')
+    else:
+        return ws_connect(f'ws://{hp[0]}:{hp[1]}/u/watch')
+
 class TestBackend(unittest.TestCase):
     ip = '127.0.0.2'
     tokens = []
@@ -57,6 +67,7 @@ class TestBackend(unittest.TestCase):
 
             print()
             res = cl.getresponse()
+            self.response = res
             print(res.status, res.reason)
             self.assertEqual(res.status, 200)
             content = res.read().decode("utf-8")
@@ -235,6 +246,7 @@ class TestBackend(unittest.TestCase):
             self.assertTrue(js.get('ok'))
 
             js = {}
+            wait_outbox()
             with open('example_email.log') as emlog:
                 for jl in emlog:
                     js = loads(jl)
@@ -330,6 +342,385 @@ class TestBackend(unittest.TestCase):
                 if n == 10:
                     self.assertFalse(ev['crossed'])
     
+    def test_ja_events_page(self):
+        device = self.devices[9]
+        js = self.get_js("/u/v/"+device['view_token'])
+        self.assertEqual(len(js['events']), 2)
+        self.assertIsNone(js['more'])
+        newest, oldest = js['events']
+        self.assertGreater(newest['ended'], oldest['ended'])
+
+        js = self.get_js("/u/v/"+device['view_token']+"?limit=1")
+        self.assertEqual([ ev['id'] for ev in js['events'] ], [newest['id']])
+        self.assertIsNotNone(js['more'])
+        self.assertEqual(js['downtime'], js['downtime_uncrossed'] + newest['downtime'])
+
+        js = self.get_js("/u/e/"+device['edit_token']+"?limit=1&before="+js['more'])
+        self.assertEqual([ ev['id'] for ev in js['events'] ], [oldest['id']])
+        self.assertIsNone(js['more'])
+
+        js = self.get_js("/u/v/"+device['view_token']+"?since="+newest['ended'].replace('+', '%2B'))
+        self.assertEqual([ ev['id'] for ev in js['events'] ], [newest['id']])
+
+        js = self.get_js("/u/v/"+device['view_token']+"?until="+newest['ended'].replace('+', '%2B')+"&before=bad")
+        self.assertIn('error', js)
+        for before in ('99999999999999999999_1', '1_99999999999999999999', '1_2_3'):
+            self.assertIn('error', self.get_js("/u/e/"+device['edit_token']+"?before="+before))
+        for since in ('9999-12-31T23:59:59-10:00', '0001-01-01T00:00:00%2B10:00'):
+            self.assertIn('error', self.get_js("/u/v/"+device['view_token']+"?since="+since))
+            self.assertIn('error', self.get_js("/u/export?tokens="+device['view_token']+"&since="+since))
+            self.assertIn('error', self.get_js("/u/sla?tokens="+device['view_token']+"&since="+since))
+
+    def test_jb_chart(self):
+        for n in (2, 9, 10):
+            device = self.devices[n]
+            js = self.get_js("/u/v/"+device['view_token'])
+            chart = self.get_js("/u/chart/"+device['view_token']+"?tz=0")
+            self.assertEqual(chart['days'][-1]['day'], datetime.utcnow().date().isoformat())
+            down = sum(day['down'] for day in chart['days'])
+            crossed = sum(day['crossed'] for day in chart['days'])
+            self.assertGreater(js['downtime'], 0)
+            self.assertAlmostEqual(down, js['downtime_uncrossed'], delta=2)
+            self.assertAlmostEqual(down + crossed, js['downtime'], delta=2)
+            for day in chart['days']:
+                for start, end, is_crossed in day['ranges']:
+                    self.assertLessEqual(0, start)
+                    self.assertLess(start, end)
+                    self.assertLessEqual(end, 24)
+
+        js = self.get_js("/u/chart/"+self.devices[9]['edit_token']+"?tz=180&since=2020-01-01&until=2020-01-03")
+        self.assertEqual([ day['day'] for day in js['days'] ], ['2020-01-01', '2020-01-02', '2020-01-03'])
+        self.assertIn('error', self.get_js("/u/chart/"+self.devices[9]['view_token']+"?tz=99999999999"))
+        self.assertIn('error', self.get_js("/u/chart/"+self.devices[9]['view_token']+"?until=0001-01-01"))
+
+    def test_jc_watch(self):
+        device = self.devices[2]
+        # With WORKERS > 1 refresh after the previous test comes in PUBSUB_TICK, maybe to a new socket
+        sleep(PUBSUB_TICK + 0.5)
+        with get_ws() as wsocket:
+            wsocket.send(device['view_token'] + '@' + 'k' * 20)
+            self.assertEqual(wsocket.recv(5), '.')
+            wsocket.send('')
+            self.assertEqual(wsocket.recv(5), '.')
+            for n in range(2):
+                js = self.get_js("/u/e/"+device['edit_token'], {'notes': f'Watched{n}'})
+                self.assertTrue(js.get('ok'))
+                self.assertEqual(wsocket.recv(5), 'refresh')
+
+        with get_ws() as wsocket:
+            wsocket.send(device['view_token'] + '@' + 'd' * 20 + '@2')
+            self.assertEqual(wsocket.recv(5), '.')
+            js = self.get_js("/u/v/"+device['view_token'])
+            vsleep(MIN_INTERVAL / BLACKOUT_COEFFICIENT)
+            self.set_ip(3)
+            self.get("/u/"+device['update_token'])
+            delta = loads(wsocket.recv(5))
+            self.assertEqual(delta['id'], device['id'])
+            self.assertEqual(delta['version'], js['version'] + 1)
+            self.assertEqual(len(delta['events']), 1)
+            self.assertEqual(delta['events'][0]['new_ip'], delta['ip'])
+            self.assertTrue(delta['ip'].startswith(f'127.{r1}.{r2}.*'))
+
+        d9, d10 = self.devices[9], self.devices[10]
+        with get_ws() as wsocket:
+            wsocket.send(d9['view_token'] + '@' + 'm' * 20)
+            self.assertEqual(wsocket.recv(5), '.')
+            wsocket.send('+' + d10['view_token'])
+            self.assertEqual(wsocket.recv(5), '.')
+            stats = self.get_js("/u/stats")
+            if WORKERS == 1:
+                self.assertGreaterEqual(stats['sockets'], 1)
+                self.assertGreaterEqual(stats['subscriptions'], 2)
+            for device in (d10, d9):
+                self.assertTrue(self.get_js("/u/e/"+device['edit_token'], {'notes': 'Multiplexed'}).get('ok'))
+                self.assertEqual(wsocket.recv(5), 'refresh')
+            wsocket.send('-' + d10['view_token'])
+            self.assertEqual(wsocket.recv(5), '.')
+            for device in (d10, d9):
+                self.assertTrue(self.get_js("/u/e/"+device['edit_token'], {'notes': 'Unsubscribed'}).get('ok'))
+            self.assertEqual(wsocket.recv(5), 'refresh')
+            wsocket.send('')
+            self.assertEqual(wsocket.recv(5), '.')
+
+    def test_jd_etag(self):
+        device = self.devices[2]
+        uri = "/u/v/" + device['view_token']
+
+        def get_etag(etag=None):
+            cl = get_cl()
+            cl.request('GET', uri, headers={'If-None-Match': etag} if etag else {})
+            res = cl.getresponse()
+            body = res.read()
+            cl.close()
+            return res.status, res.getheader('ETag'), body
+
+        status, etag, body = get_etag()
+        self.assertEqual(status, 200)
+        self.assertTrue(etag)
+        self.assertEqual(get_etag(), (200, etag, body))
+        self.assertEqual(get_etag(etag)[0], 304)
+
+        js = self.get_js("/u/e/"+device['edit_token'], {'notes': 'ETag'})
+        self.assertTrue(js.get('ok'))
+        status, new_etag, body = get_etag(etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(loads(body)['notes'], 'ETag')
+
+    def test_je_bulk(self):
+        d4, d5 = self.devices[4], self.devices[5]
+        ip = f'127.{r1}.{r2}.44'
+        now = time()
+        js = self.get_js("/u/bulk", [[d5['update_token']], [d4['update_token'], ip], [d4['update_token'], ip], 
+            [d5['update_token'], None, now - MIN_INTERVAL], ['bad'], [1], [d5['update_token'], 'bad ip'], 
+            [d5['update_token'], None, now - MAX_INTERVAL - 100]])
+        self.assertEqual(js, [[str(MIN_INTERVAL), DEFAULT_INTERVAL], ['', DEFAULT_INTERVAL], ['too often', DEFAULT_INTERVAL], 
+            ['', DEFAULT_INTERVAL], ['bad token', None], ['bad arguments', None], ['bad arguments', None], ['bad time', None]])
+
+        js = self.get_js("/u/e/"+d4['edit_token'])
+        self.assertEqual(js['ip'], f'127.{r1}.{r2}.*')
+        self.assertEqual(js['version'], d4['version'] + 1)
+        self.assertEqual([ e['new_ip'] for e in js['events'] ], [js['ip']])
+        js = self.get_js("/u/e/"+d5['edit_token'])
+        self.assertEqual(len(js['events']), 1)
+
+        self.assertEqual(self.get("/u/"+d4['update_token']), 'too often')
+
+    def test_jf_create_bulk(self):
+        self.set_ip(5)
+        self.assertIn('error', self.get_js("/u/create_devices", {'count': 0}))
+        js = self.get_js("/u/create_devices", {'count': REG_PER_IP + 1})
+        self.assertTrue(js.get('ok'))
+        devices = js['devices']
+        self.assertEqual(len(devices), REG_PER_IP + 1)
+        self.assertEqual(len({ d['edit_token'] for d in devices } | { d['update_token'] for d in devices }), 
+            2 * len(devices))
+        self.assertTrue(self.get_js("/u/create_devices", {'count': 1, 'admin_key': 'wrong'}).get('blocked'))
+        self.assertTrue(self.get_js("/u/create_device", {}).get('blocked'))
+
+        js = self.get_js("/u/e/" + devices[-1]['edit_token'])
+        self.assertEqual(js['id'], devices[-1]['id'])
+        self.assertEqual(js['title'], f"Device {js['id']}")
+        self.assertEqual(js['interval'], DEFAULT_INTERVAL)
+        self.assertIsNone(js['updated'])
+        self.assertEqual(self.get("/u/" + devices[-1]['update_token']), '')
+        self.devices.extend(devices)
+
+    def test_jg_export(self):
+        d2, d9 = self.devices[2], self.devices[9]
+        events = []
+        for device in (d2, d9):
+            js = self.get_js("/u/e/"+device['edit_token'])
+            events += [ {'device_id': js['id'], **event} for event in sorted(js['events'], key=lambda e: e['ended']) ]
+        self.assertTrue(events)
+
+        tokens = d9['edit_token'] + ',' + d2['view_token'] + ',bad'
+        lines = self.get("/u/export?tokens=" + tokens).splitlines()
+        self.assertEqual([ loads(line) for line in lines ], events)
+
+        lines = self.get("/u/export?format=csv&tokens=" + tokens).splitlines()
+        self.assertEqual(lines[0], 'device_id,id,started,ended,downtime,old_ip,new_ip,comment,crossed')
+        self.assertEqual([ int(line.split(',')[1]) for line in lines[1:] ], [ event['id'] for event in events ])
+
+        lines = self.get("/u/export?since=2000-01-01T00:00:00&until=2000-01-02T00:00:00&tokens=" + tokens)
+        self.assertEqual(lines, '')
+        self.assertIn('error', self.get_js("/u/export?tokens=bad"))
+        self.assertIn('error', self.get_js("/u/export?format=xml&tokens=" + tokens))
+
+    def test_jh_metrics(self):
+        lines = self.get("/u/metrics").splitlines()
+        values = { line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1]) for line in lines if not line.startswith('#') }
+        if WORKERS == 1:
+            self.assertGreater(values['blackouts_request_seconds_count{route="update"}'], 0)
+            self.assertGreater(values['blackouts_heartbeats_total'], 0)
+            self.assertGreater(values['blackouts_db_query_seconds_count'], 0)
+        self.assertIn('blackouts_ws_sockets', values)
+        self.assertIn('# TYPE blackouts_request_seconds histogram', lines)
+
+    @unittest.skipUnless(SQL_TRACE, 'SQL_TRACE is off')
+    def test_ji_sql_budget(self):
+        def assert_budget(uri, body=None, queries=2, sessions=1):
+            self.get(uri, body)
+            # ips table is queried unless it's in memory
+            queries += IPS_INDEX != 'memory'
+            self.assertLessEqual(int(self.response.getheader('X-SQL-Queries')), queries, uri)
+            self.assertLessEqual(int(self.response.getheader('X-SQL-Sessions')), sessions, uri)
+
+        self.set_ip(12)
+        js = self.get_js("/u/create_device", {})
+        self.assertLessEqual(int(self.response.getheader('X-SQL-Queries')), 3)
+        device = self.get_js("/u/e/" + js['new_token'])
+        assert_budget("/u/e/" + device['edit_token'] + "?limit=5")
+        assert_budget("/u/v/" + device['view_token'] + "?limit=5")
+        assert_budget("/u/" + device['update_token'], queries=4)
+        # Too often, rejected in memory by the worker that accepted the previous one
+        assert_budget("/u/" + device['update_token'], queries=int(WORKERS > 1))
+        assert_budget("/u/listing")
+        assert_budget("/u/chart/" + device['view_token'])
+        assert_budget("/u/bulk", [[device['update_token']]] * 3, queries=3, sessions=3)
+        self.devices.append(device)
+
+    def test_jj_sla(self):
+        d2, d9, d10 = self.devices[2], self.devices[9], self.devices[10]
+        js = self.get_js("/u/sla?tokens=" + ','.join([d2['view_token'], d9['edit_token'], str(d10['id']), 'bad']))
+        self.assertEqual([ device['id'] for device in js['devices'] ], sorted([d2['id'], d9['id']]))
+        for device in js['devices']:
+            self.assertEqual(len(device['windows']), 3)
+            for window in device['windows']:
+                self.assertGreaterEqual(window['outages'], 1)
+                self.assertLess(window['uptime'], 100)
+                self.assertGreaterEqual(window['longest'], 1)
+
+        event = [ e for e in self.get_js("/u/v/"+d9['view_token'])['events'] if e['downtime'] ][0]
+        started, ended = datetime.fromisoformat(event['started']), datetime.fromisoformat(event['ended'])
+        def window(since, until, crossed=1):
+            js = self.get_js(f"/u/sla?tokens={d9['view_token']}&crossed={crossed}&since=" + 
+                since.isoformat().replace('+', '%2B') + "&until=" + until.isoformat().replace('+', '%2B'))
+            return js['devices'][0]['windows'][0]
+
+        js = window(started - timedelta(seconds=5), ended)
+        self.assertAlmostEqual(js['downtime'], event['downtime'], delta=1)
+        self.assertEqual(js['outages'], 1)
+        self.assertEqual(window(started - timedelta(seconds=5), ended, crossed=0)['outages'], 0)
+        # Parts of the outage
+        half = started + (ended - started) / 2
+        js = window(half, ended + timedelta(seconds=5))
+        self.assertAlmostEqual(js['downtime'], (ended - half).total_seconds(), delta=1)
+        js = window(started - timedelta(seconds=5), half)
+        self.assertAlmostEqual(js['longest'], (half - started).total_seconds(), delta=1)
+        js = window(started + timedelta(seconds=1), started + timedelta(seconds=3))
+        self.assertEqual((js['downtime'], js['outages'], js['uptime']), (2, 1, 0))
+
+        js = self.get_js(f"/u/sla?tokens={d9['view_token']}&since=2000-01-01T00:00:00&until=2000-01-02T00:00:00")
+        self.assertIsNone(js['devices'][0]['windows'][0]['uptime'])
+        self.assertIn('error', self.get_js(f"/u/sla?tokens={d9['view_token']}&days=x"))
+        js = self.get_js(f"/u/sla?tokens={d9['view_token']}&days=99999999999,{SLA_MAX_DAYS}")
+        self.assertEqual(js['devices'][0]['windows'][0]['since'], js['devices'][0]['windows'][1]['since'])
+        self.assertIn('error', self.get_js(f"/u/sla?tokens={d9['view_token']}&days=-99999999999"))
+        self.assertIn('error', self.get_js("/u/sla?tokens=bad"))
+
+    def test_jk_coefficient(self):
+        # Gaps between 2 and BLACKOUT_COEFFICIENT intervals are not downtime, in /u/bulk (sql) and /u/<token> as well
+        self.set_ip(30)
+        devices = self.get_js("/u/create_devices", {'count': 4})['devices']
+        self.devices.extend(devices)
+        a, b, c, d = [ device['update_token'] for device in devices ]
+        short, long = DEFAULT_INTERVAL * 2.2, DEFAULT_INTERVAL * 2.7
+        now = time()
+        self.get_js("/u/bulk", [[a, None, now - short], [a, None, now], [b, None, now - short], [c, None, now - long], 
+            [d, None, now - long], [d, None, now]])
+        self.get("/u/" + b)
+        self.get("/u/" + c)
+        downtime = [ self.get_js("/u/e/" + device['edit_token'])['downtime'] for device in devices ]
+        self.assertEqual(downtime[:2], [0, 0])
+        self.assertGreaterEqual(downtime[2], long - 1)
+        self.assertGreaterEqual(downtime[3], long - 1)
+
+    def test_jl_ip_change(self):
+        # Event of ip change starts at the last update, even if it's only in memory (HEARTBEAT_MODE="cache")
+        self.set_ip(31)
+        device = self.get_js("/u/create_devices", {'count': 1})['devices'][0]
+        self.devices.append(device)
+        self.get("/u/" + device['update_token'])
+        sleep(MIN_INTERVAL / BLACKOUT_COEFFICIENT + 0.5)
+        updated = time()
+        self.assertTrue(self.get("/u/" + device['update_token']).isdigit())
+        sleep(MIN_INTERVAL / BLACKOUT_COEFFICIENT + 0.5)
+        self.set_ip(32)
+        self.get("/u/" + device['update_token'])
+        event = self.get_js("/u/e/" + device['edit_token'])['events'][0]
+        self.assertIsNone(event['downtime'])
+        self.assertAlmostEqual(datetime.fromisoformat(event['started']).timestamp(), updated, delta=1)
+
+    def test_jm_down_again(self):
+        # Down email after the last alive message (test_j_update, test_jc_watch). With WORKERS > 1 it may have come 
+        # to another process than the one which handled verify_email and sent the first down email
+        device = self.devices[2]
+        js = self.get_js("/u/e/"+device['edit_token'])
+        updated = datetime.fromisoformat(js['updated']).timestamp()
+        vsleep(max(0, updated + js['notify_interval'] + 3 - time()))
+        wait_outbox()
+        with open('example_email.log') as emlog:
+            self.assertTrue([ js for js in map(loads, emlog) if js['to'] == device['email'] and 
+                js['subject'].endswith('is down') and js['timestamp'] > updated ])
+
+    @unittest.skipIf(WORKERS == 1, 'single worker')
+    def test_jn_pubsub(self):
+        # Alive message handled by one worker reaches websockets held by others, through LISTEN/NOTIFY
+        self.set_ip(33)
+        device = self.get_js("/u/create_devices", {'count': 1})['devices'][0]
+        self.devices.append(device)
+        # Refresh after device creation is published in PUBSUB_TICK
+        sleep(PUBSUB_TICK + 0.5)
+        sockets = [ get_ws() for n in range(4 * WORKERS) ]
+        try:
+            for n, wsocket in enumerate(sockets):
+                wsocket.send(device['view_token'] + '@' + f'p{n:019}' + '@2')
+                self.assertEqual(wsocket.recv(5), '.')
+            pids = {}
+            for n in range(10 * WORKERS):
+                stats = self.get_js("/u/stats")
+                pids[stats['pid']] = stats['sockets']
+            self.assertLessEqual(sum(pids.values()), len(sockets))
+            self.assertGreater(len([ pid for pid, count in pids.items() if count ]), 1)
+
+            self.get("/u/" + device['update_token'])
+            for wsocket in sockets:
+                delta = loads(wsocket.recv(5))
+                self.assertEqual(delta['id'], device['id'])
+                self.assertTrue(delta['ip'].startswith(f'127.{r1}.{r2}.*'))
+        finally:
+            for wsocket in sockets:
+                wsocket.close()
+
+    def test_jo_compact(self):
+        # Events older than retention are moved to events_daily, a day compacted in parts is summed
+        self.set_ip(34)
+        device = self.get_js("/u/create_devices", {'count': 1})['devices'][0]
+        self.devices.append(device)
+        now = time()
+        token = device['update_token']
+        self.get_js("/u/bulk", [[token, None, now - 300], [token, None, now - 200], [token, None, now - 100]])
+        downtime = self.get_js("/u/e/" + device['edit_token'])['downtime']
+        self.assertGreater(downtime, 0)
+
+        async def run():
+            retention = tgt.EVENTS_RETENTION_DAYS
+            tgt.EVENTS_RETENTION_DAYS = 365
+            try:
+                async with tgt.engine.begin() as db:
+                    ids = (await db.scalars(tgt.select(tgt.Event.id).filter_by(device_id=device['id'])
+                        .order_by(tgt.Event.id))).all()
+                # First event (new ip), then two downtimes without ip change. All aged to the same day, one by one
+                self.assertEqual(len(ids), 3)
+                day = tgt.datetime.utcnow().replace(hour=12) - tgt.timedelta(days=400)
+                rows = []
+                for id in (ids[1], ids[2], ids[0]):
+                    async with tgt.engine.begin() as db:
+                        await db.execute(tgt.sql('UPDATE events SET ended = CAST(:day AS timestamp), '
+                            'started = CAST(:day AS timestamp) - (ended - started) WHERE id = :id'), {'day': day, 'id': id})
+                    self.assertGreaterEqual(await tgt.events_compact(), 1)
+                    async with tgt.engine.begin() as db:
+                        rows.append((await db.execute(tgt.select(tgt.EventsDaily.__table__)
+                            .where(tgt.EventsDaily.device_id == device['id']))).all())
+                self.assertEqual(await tgt.events_compact(), 0)
+
+                for n, days in enumerate(rows):
+                    self.assertEqual([ daily.day for daily in days ], [day.date()])
+                    self.assertEqual(days[0].events, n + 1)
+                self.assertEqual([ days[0].ips for days in rows ], [[], [], [f'127.{r1}.{r2}.34']])
+                self.assertEqual([ days[0].outages for days in rows ], [1, 2, 2])
+                self.assertEqual(rows[-1][0].downtime + rows[-1][0].crossed_downtime, downtime)
+                async with tgt.engine.begin() as db:
+                    self.assertEqual(await db.scalar(tgt.select(tgt.func.count()).select_from(tgt.Event)
+                        .filter_by(device_id=device['id'])), 0)
+            finally:
+                tgt.EVENTS_RETENTION_DAYS = retention
+                await tgt.engine.dispose()
+
+        asyncio.run(run())
+        self.assertEqual(self.get_js("/u/v/" + device['view_token'])['downtime'], downtime)
+
     def test_k_delete(self):
         for device in self.devices:
             js = self.get_js("/u/delete_device/"+device['edit_token'], {})
@@ -339,6 +730,7 @@ class TestBackend(unittest.TestCase):
 
 def search_email(ts, device, up=False):
     js = {}
+    wait_outbox()
     with open('example_email.log') as emlog:
         for jl in emlog:
             js = loads(jl)
@@ -352,6 +744,19 @@ def search_email(ts, device, up=False):
     
     return False
 
+def wait_outbox(timeout=10):
+    # Emails are written to the log by the outbox worker before it marks them as sent
+    async def pending():
+        try:
+            async with tgt.autocommit.connect() as db:
+                return await db.scalar(tgt.select(tgt.func.count()).where(tgt.Outbox.status == 'pending'))
+        finally:
+            await tgt.engine.dispose()
+
+    deadline = time() + timeout
+    while asyncio.run(pending()) and time() < deadline:
+        sleep(0.05)
+
 def vsleep(n):
     print('sleep', n)
     sleep(n)
\ No newline at end of file
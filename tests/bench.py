@@ -0,0 +1,424 @@
+# Execute (from ~/blackouts directory): env/bin/python tests/bench.py [--workers 4] [--devices 2000] [--rate 500]
+# Load test. Starts its own server (blackouts.py with --workers processes) on a unix socket in a temporary directory,
+# with CONFIG.py of this directory and benchmark settings (server_start), and stops it at the end. Runs against a throwaway database 
+# created next to the one in SQLALCHEMY_URL and dropped at the end, or --database (devices are deleted at the end).
+# Emails go to the @example.com sink (example_email.log in the temporary directory), no SMTP server is used.
+#
+# Phases:
+#   email     - --alerting devices get an @example.com email, confirmed with the code from the sink, and down/up 
+#               notifications. Time from the request to the email in the sink (outbox delivery)
+#   heartbeat - alive messages (/u/<update_token>) of all devices at --rate per second (0 - as fast as possible)
+#   bulk      - the same alive messages sent by POST /u/bulk in batches of --batch
+#   listing   - /u/listing and /u/v/<view_token> requests
+#   watch     - --watchers websockets subscribed to --watched devices, time from saving a device to receiving refresh
+#   alerts    - alerting devices stop sending alive messages. Time from the down deadline (last message + 
+#               --interval) to the "is down" email, then from the next alive message to the "is online" email
+# Reports throughput and latency percentiles (milliseconds) to the json file, with the commit and settings
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from json import dumps, loads
+from random import SystemRandom
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from websockets.client import unix_connect as ws_unix_connect
+
+sys.path.append('.')
+
+from CONFIG import *
+
+random = SystemRandom()
+
+
+class server:
+    # Started by server_start
+    process = None
+    directory = None
+    socket = None
+    admin_key = None
+    log = None
+    # Throwaway database URL, dropped by server_stop
+    database = None
+
+
+class HTTPClient:
+    '''
+    Minimal HTTP/1.1 keep-alive client, one request at a time. Requests are sent from ip (forwarded)
+    '''
+    def __init__(self, ip='127.0.0.2'):
+        self.ip = ip
+        self.reader = self.writer = None
+        # Of the last response, lower case names
+        self.headers = {}
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(server.socket)
+
+    async def request(self, uri, body=None):
+        '''
+        Returns status and response body (str). POST with json body if body is not None
+        '''
+        if not self.writer:
+            await self.connect()
+        data = dumps(body).encode() if body is not None else b''
+        forwarded = f'for={self.ip};by="_tests";proto=https;host="{DOMAIN}";path="/a/v";secret={FORWARDED_SECRET}'
+        self.writer.write((f"{'GET' if body is None else 'POST'} {uri} HTTP/1.1\r\nHost: localhost\r\n"
+            f"Forwarded: {forwarded}\r\nContent-Length: {len(data)}\r\n\r\n").encode() + data)
+        status = int((await self.reader.readline()).split()[1])
+        self.headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''): break
+            name, value = line.decode().split(':', 1)
+            self.headers[name.lower()] = value.strip()
+        return status, (await self.reader.readexactly(int(self.headers.get('content-length', 0)))).decode()
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    if not latencies: return {}
+    pick = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 2)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': round(latencies[-1] * 1000, 2)}
+
+async def run_requests(requests, concurrency, rate=0):
+    '''
+    Sends requests (list of (uri, body)) over concurrency connections. With rate, request n is scheduled at n / rate
+    seconds, and latency is counted from that time (a slow server is not hidden by requests sent later).
+    Returns stats: requests, errors, seconds, rps, latency percentiles, counts of response texts.
+    With SQL_TRACE on the server, also max and average database statements and sessions per request
+    '''
+    latencies = []
+    results = {}
+    errors = 0
+    sql = {'queries': [], 'sessions': []}
+    next_request = iter(enumerate(requests))
+    start = time.monotonic()
+
+    async def worker():
+        nonlocal errors
+        client = HTTPClient()
+        try:
+            for n, (uri, body) in next_request:
+                scheduled = start + n / rate if rate else time.monotonic()
+                if scheduled > time.monotonic():
+                    await asyncio.sleep(scheduled - time.monotonic())
+                try:
+                    status, content = await client.request(uri, body)
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    client.close()
+                    errors += 1
+                    continue
+                latencies.append(time.monotonic() - scheduled)
+                key = str(status) if status != 200 else content if content in ('too often', 'bad token') else 'ok'
+                results[key] = results.get(key, 0) + 1
+                for k in sql:
+                    if 'x-sql-' + k in client.headers:
+                        sql[k].append(int(client.headers['x-sql-' + k]))
+        finally:
+            client.close()
+
+    await asyncio.gather(*[ worker() for _ in range(concurrency) ])
+    seconds = time.monotonic() - start
+    stats = {'requests': len(requests), 'errors': errors, 'seconds': round(seconds, 3),
+        'rps': round(len(requests) / seconds, 1), 'latency_ms': percentiles(latencies), 'results': results}
+    for k, values in sql.items():
+        if values:
+            stats['sql_' + k] = {'max': max(values), 'avg': round(sum(values) / len(values), 2)}
+    return stats
+
+async def server_start(args):
+    '''
+    Creates the throwaway database (unless --database), writes CONFIG.py to a temporary directory and starts 
+    blackouts.py there (python -m, so its CONFIG is found first). Waits until it answers
+    '''
+    url = args.database
+    if not url:
+        url = make_url(SQLALCHEMY_URL).set(database=make_url(SQLALCHEMY_URL).database + '_bench')
+        admin = create_async_engine(url.set(database='postgres'), isolation_level='AUTOCOMMIT')
+        async with admin.connect() as db:
+            await db.execute(text(f'DROP DATABASE IF EXISTS "{url.database}"'))
+            await db.execute(text(f'CREATE DATABASE "{url.database}"'))
+        await admin.dispose()
+        server.database = url
+        url = url.render_as_string(hide_password=False)
+
+    server.directory = tempfile.mkdtemp(prefix='blackouts-bench-')
+    server.socket = os.path.join(server.directory, 'blackouts.sanic')
+    server.admin_key = f'bench{random.randrange(10**9)}'
+    with open('CONFIG.py') as f:
+        config = f.read()
+    with open(os.path.join(server.directory, 'CONFIG.py'), 'w') as f:
+        f.write(config + f'''
+# Benchmark settings
+SANIC_SOCKET="unix:{server.socket}"
+SQLALCHEMY_URL="{url}"
+WORKERS={args.workers}
+HEARTBEAT_MODE="{args.mode}"
+ADMIN_KEY="{server.admin_key}"
+MIN_INTERVAL={args.interval}
+DEFAULT_INTERVAL={args.interval}
+MAILER_RATE=0
+SQL_TRACE={int(args.sql_trace)}
+''')
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath('.'))
+    server.log = open(os.path.join(server.directory, 'server.log'), 'w')
+    server.process = subprocess.Popen([sys.executable, '-m', 'blackouts'], cwd=server.directory, env=env, 
+        stdout=server.log, stderr=subprocess.STDOUT)
+    for n in range(300):
+        if server.process.poll() is not None:
+            raise RuntimeError(f'Server exited, see {server.log.name}')
+        # Connections made while the socket is bound again by workers are never answered
+        client = HTTPClient()
+        try:
+            status, content = await asyncio.wait_for(client.request('/u/stats'), 1)
+            if status == 200: return
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            client.close()
+        await asyncio.sleep(0.1)
+    raise RuntimeError(f'Server is not answering, see {server.log.name}')
+
+async def server_stop():
+    '''
+    Stops the server (SIGINT, as Ctrl+C) and drops the throwaway database. The temporary directory is kept
+    '''
+    if server.process:
+        server.process.send_signal(signal.SIGINT)
+        try:
+            server.process.wait(30)
+        except subprocess.TimeoutExpired:
+            server.process.kill()
+            server.process.wait()
+        server.log.close()
+    if server.database:
+        admin = create_async_engine(server.database.set(database='postgres'), isolation_level='AUTOCOMMIT')
+        async with admin.connect() as db:
+            await db.execute(text(f'DROP DATABASE IF EXISTS "{server.database.database}" WITH (FORCE)'))
+        await admin.dispose()
+
+def sink_emails(since):
+    '''
+    Emails written to the @example.com sink after since (time.time)
+    '''
+    try:
+        with open(os.path.join(server.directory, 'example_email.log')) as f:
+            return [ js for js in map(loads, f) if js['timestamp'] >= since ]
+    except FileNotFoundError:
+        return []
+
+async def wait_emails(count, since, subject, timeout):
+    '''
+    Waits for count sink emails with subject ending with subject, returns dict address: email timestamp
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        emails = { js['to']: js['timestamp'] for js in sink_emails(since) if js['subject'].endswith(subject) }
+        if len(emails) >= count or time.monotonic() > deadline:
+            return emails
+        await asyncio.sleep(0.1)
+
+def email_of(device):
+    return f"bench{device['id']}@example.com"
+
+async def provision(count):
+    '''
+    Creates count devices, returns list of dicts with id and tokens
+    '''
+    devices = []
+    client = HTTPClient()
+    try:
+        while len(devices) < count:
+            batch = {'count': min(count - len(devices), REG_BULK_MAX), 'admin_key': server.admin_key}
+            status, content = await client.request('/u/create_devices', batch)
+            js = loads(content)
+            if not js.get('ok'): raise RuntimeError(f'Cannot create devices: {content}')
+            devices += js['devices']
+    finally:
+        client.close()
+    return devices
+
+async def bench_email(devices, args):
+    '''
+    Sets sink emails and down/up notifications of devices, confirms emails with codes from the sink
+    '''
+    start = time.time()
+    await run_requests([ ('/u/e/' + d['edit_token'], {'notifyoff': True, 'notifyon': True, 
+        'notify_interval': args.interval}) for d in devices ], args.concurrency)
+    sent = time.time()
+    stats = await run_requests([ ('/u/email_send_code/' + d['edit_token'], {'email': email_of(d)}) for d in devices ],
+        args.concurrency)
+    subject = f'welcome to {DOMAIN}'
+    emails = await wait_emails(len(devices), start, subject, 30)
+    codes = { js['to']: js['content'].split('<b>')[1].split('</b>')[0] for js in sink_emails(start) 
+        if js['subject'].endswith(subject) }
+    stats['delivered'] = len(emails)
+    stats['delivery_ms'] = percentiles([ emails[email_of(d)] - sent for d in devices if email_of(d) in emails ])
+    stats['verify'] = await run_requests([ ('/u/verify_email/' + d['edit_token'], {'vcode': codes.get(email_of(d), '')})
+        for d in devices ], args.concurrency)
+    return stats
+
+async def bench_alerts(devices, args):
+    '''
+    One alive message from each device, then none: down emails are due --interval later. Then alive messages again 
+    after downtime, each gives an up email
+    '''
+    # Not too often after the previous phases
+    await asyncio.sleep(args.interval)
+    stats = {'devices': len(devices)}
+    last = {}
+
+    async def alive():
+        # New connection, the previous one is closed by keep-alive timeout while waiting for emails
+        client = HTTPClient()
+        try:
+            for d in devices:
+                await client.request('/u/' + d['update_token'])
+                last[email_of(d)] = time.time()
+        finally:
+            client.close()
+
+    start = time.time()
+    await alive()
+    down = await wait_emails(len(devices), start, 'is down', args.interval * 3 + 30)
+    stats['down'] = len(down)
+    stats['down_delay_ms'] = percentiles([ down[email] - last[email] - args.interval for email in down ])
+
+    # Up emails are sent after downtime, when the gap is over interval * BLACKOUT_COEFFICIENT
+    await asyncio.sleep(max(last.values()) + args.interval * BLACKOUT_COEFFICIENT + 1 - time.time())
+    start = time.time()
+    await alive()
+    up = await wait_emails(len(devices), start, 'is online', 30)
+    stats['up'] = len(up)
+    stats['up_delivery_ms'] = percentiles([ up[email] - last[email] for email in up ])
+    return stats
+
+async def bench_watch(devices, watchers, rounds):
+    '''
+    Opens watchers websockets, subscribed to view tokens of devices (round robin). Saves every device rounds times
+    and measures time until each subscriber gets refresh
+    '''
+    sockets = []
+    for n in range(watchers):
+        wsocket = await ws_unix_connect(server.socket, 'ws://localhost/u/watch')
+        await wsocket.send(devices[n % len(devices)]['view_token'] + '@' + f'bench{n:015d}')
+        await wsocket.recv()
+        sockets.append(wsocket)
+
+    latencies = []
+    missed = 0
+    client = HTTPClient()
+    start = time.monotonic()
+    try:
+        for r in range(rounds):
+            for n, device in enumerate(devices):
+                subscribers = sockets[n::len(devices)]
+                sent = time.monotonic()
+                await client.request('/u/e/' + device['edit_token'], {'notes': f'Bench {r}'})
+
+                async def receive(wsocket):
+                    while await wsocket.recv() != 'refresh': pass
+                    return time.monotonic() - sent
+
+                for res in await asyncio.gather(*[ asyncio.wait_for(receive(wsocket), 5) for wsocket in subscribers ],
+                    return_exceptions=True):
+                    if isinstance(res, float):
+                        latencies.append(res)
+                    else:
+                        missed += 1
+                # Refresh of the same device is not sent more often
+                await asyncio.sleep(0.01)
+    finally:
+        client.close()
+        for wsocket in sockets:
+            await wsocket.close()
+    seconds = time.monotonic() - start
+    return {'watchers': watchers, 'devices': len(devices), 'refreshes': len(latencies), 'missed': missed,
+        'seconds': round(seconds, 3), 'latency_ms': percentiles(latencies)}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+async def main(args):
+    report = {'commit': git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 
+        'settings': { k: v for k, v in vars(args).items() if k != 'database' },
+        'server': {'HEARTBEAT_MODE': args.mode, 'WORKERS': args.workers, 'IPS_INDEX': IPS_INDEX}}
+
+    devices = []
+    try:
+        print('Starting server with', args.workers, 'workers')
+        await server_start(args)
+        print('Creating', args.devices, 'devices')
+        start = time.monotonic()
+        devices = await provision(args.devices)
+        report['provision'] = {'devices': len(devices), 'seconds': round(time.monotonic() - start, 3)}
+        alerting = devices[len(devices) - min(args.alerting, len(devices)):]
+        if alerting:
+            print('email')
+            report['email'] = await bench_email(alerting, args)
+
+        print('heartbeat')
+        report['heartbeat'] = await run_requests([ ('/u/' + d['update_token'], None) for d in devices ] * args.rounds,
+            args.concurrency, args.rate)
+
+        print('bulk')
+        batches = [ [ [d['update_token']] for d in devices[n:n + args.batch] ]
+            for n in range(0, len(devices), args.batch) ]
+        report['bulk'] = await run_requests([ ('/u/bulk', batch) for batch in batches ], args.concurrency)
+        report['bulk']['messages_per_second'] = round(len(devices) / report['bulk']['seconds'], 1)
+
+        print('listing')
+        report['listing'] = await run_requests([ ('/u/listing', None) ] * args.listing, args.concurrency)
+        report['view'] = await run_requests([ ('/u/v/' + random.choice(devices)['view_token'], None)
+            for n in range(args.listing) ], args.concurrency)
+
+        print('watch')
+        report['watch'] = await bench_watch(devices[:args.watched], args.watchers, args.rounds)
+
+        if alerting:
+            print('alerts')
+            report['alerts'] = await bench_alerts(alerting, args)
+    finally:
+        if devices and server.process.poll() is None:
+            print('Deleting devices')
+            await run_requests([ ('/u/delete_device/' + d['edit_token'], {}) for d in devices ], args.concurrency)
+        print('Stopping server, log in', server.directory)
+        await server_stop()
+
+    with open(args.out, 'w') as f:
+        f.write(dumps(report, indent=2))
+    print(dumps(report, indent=2))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Blackouts load test')
+    parser.add_argument('--workers', type=int, default=2, help='server processes')
+    parser.add_argument('--mode', default=HEARTBEAT_MODE, choices=('orm', 'sql', 'cache'), help='HEARTBEAT_MODE')
+    parser.add_argument('--database', help='SQLAlchemy URL of an existing database instead of a throwaway one')
+    parser.add_argument('--sql-trace', action='store_true', help='SQL_TRACE on the server, statements per request')
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=0, help='alive messages per second, 0 - unlimited')
+    parser.add_argument('--rounds', type=int, default=1, help='alive messages per device, and saves per watched device')
+    parser.add_argument('--concurrency', type=int, default=32, help='http connections')
+    parser.add_argument('--batch', type=int, default=500, help='alive messages per /u/bulk request')
+    parser.add_argument('--listing', type=int, default=1000, help='number of /u/listing and /u/v requests')
+    parser.add_argument('--watchers', type=int, default=200, help='websocket subscribers')
+    parser.add_argument('--watched', type=int, default=10, help='devices the subscribers are watching')
+    parser.add_argument('--alerting', type=int, default=100, help='devices with email and down/up notifications')
+    parser.add_argument('--interval', type=int, default=10, help='MIN_INTERVAL, alive and down notification interval')
+    parser.add_argument('--out', default='bench.json')
+    asyncio.run(main(parser.parse_args()))
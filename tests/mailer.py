@@ -0,0 +1,92 @@
+# Execute (from ~/blackouts directory): env/bin/python -m unittest tests.mailer
+# Needs aiosmtpd (pip install aiosmtpd), a local SMTP server is started instead of MAILER_SERVER
+import unittest
+import asyncio
+import socket
+import sys
+
+sys.path.append('.')
+
+import mailer
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:
+    Controller = None
+
+class Handler:
+    def __init__(self):
+        self.messages = []
+        self.logins = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        self.logins += 1
+        return AuthResult(success=auth_data.login == b'user' and auth_data.password == b'password')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class TestPool(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.handler = Handler()
+        self.port = free_port()
+        self.start_server()
+        self.config = { k: getattr(mailer, k) for k in ('MAILER_SERVER', 'MAILER_PORT', 'MAILER_TLS', 'MAILER_USERNAME',
+            'MAILER_PASSWORD', 'MAILER_POOL_SIZE') }
+        mailer.MAILER_SERVER = '127.0.0.1'
+        mailer.MAILER_PORT = self.port
+        mailer.MAILER_TLS = False
+        mailer.MAILER_USERNAME = 'user'
+        mailer.MAILER_PASSWORD = 'password'
+        mailer.MAILER_POOL_SIZE = 2
+        mailer.pool.idle = []
+        mailer.pool.semaphore = None
+
+    def tearDown(self):
+        self.controller.stop()
+        for k, v in self.config.items():
+            setattr(mailer, k, v)
+        mailer.pool.idle = []
+        mailer.pool.semaphore = None
+
+    def start_server(self):
+        self.controller = Controller(self.handler, hostname='127.0.0.1', port=self.port,
+            authenticator=self.handler.authenticate, auth_require_tls=False)
+        self.controller.start()
+
+    async def test_reuse(self):
+        await asyncio.gather(*[ mailer.device_down(f'user{n}@test.local', f'Device {n}', 'token') for n in range(10) ])
+        self.assertEqual(len(self.handler.messages), 10)
+        self.assertEqual(self.handler.logins, 2)
+        self.assertEqual(len(mailer.pool.idle), 2)
+
+        await mailer.device_up('user@test.local', 'Device', 'token')
+        self.assertEqual(len(self.handler.messages), 11)
+        self.assertEqual(self.handler.logins, 2)
+
+        await mailer.close()
+        self.assertEqual(mailer.pool.idle, [])
+
+    async def test_reconnect(self):
+        await mailer.device_down('user@test.local', 'Device', 'token')
+        # Idle connection is dropped by the server
+        self.controller.stop()
+        self.start_server()
+        await mailer.device_up('user@test.local', 'Device', 'token')
+        self.assertEqual(len(self.handler.messages), 2)
+        self.assertEqual(self.handler.logins, 2)
+
+    async def test_error(self):
+        mailer.MAILER_PORT = free_port()
+        with self.assertRaises(Exception):
+            await mailer.device_down('user@test.local', 'Device', 'token')
+        self.assertEqual(mailer.pool.idle, [])
+        self.assertEqual(self.handler.messages, [])
@@ -1,5 +1,7 @@
 # Execute (from ~/blackouts directory): env/bin/python -m unittest tests.utils
 import unittest
+import asyncio
+import time
 import sys
 
 sys.path.append('.')
@@ -25,3 +27,350 @@ class TestFunctions(unittest.TestCase):
             self.assertEqual(len(rs), 20)
             self.assertNotIn(rs, rss)
             rss.append(rs)
+
+    def test_ip_index(self):
+        index = tgt.IPIndex()
+        self.assertIsNone(index.lookup(10))
+        rows = [ tgt.IPs(a=a, b=b, isp=isp) for a, b, isp in ((300, 400, 'C'), (100, 199, 'A'), (200, 255, 'B'), 
+            (1000, 2000, 'D'), (1100, 1200, 'E')) ]
+        index.build(rows)
+        for ip, isp in ((99, None), (100, 'A'), (150, 'A'), (199, 'A'), (200, 'B'), (255, 'B'), (256, None), (400, 'C'), 
+                (401, None), (1050, 'D'), (1150, 'E'), (1201, 'D'), (2000, 'D'), (2001, None)):
+            ip_info = index.lookup(ip)
+            self.assertEqual(ip_info.isp if ip_info else None, isp)
+
+    @unittest.skipUnless(tgt.IPS_INDEX == 'memory', 'ips are searched in the database')
+    def test_ip_infos(self):
+        tgt.ip_infos.clear()
+        tgt.ip_infos.set('8.8.8.8', tgt.IPInfo('US'))
+        self.assertEqual(tgt.ip_country('8.8.8.8'), 'US')
+        infos = asyncio.run(tgt.ip_infos_many(None, ['8.8.8.8', None, '8.8.8.8', '10.0.0.1']))
+        self.assertEqual(list(infos), ['8.8.8.8', '10.0.0.1'])
+        self.assertEqual(infos['8.8.8.8'].masked, '8.8.8.* (US)')
+        self.assertIsNone(infos['10.0.0.1'].country)
+        self.assertEqual(infos['10.0.0.1'].masked, '10.0.0.*')
+        self.assertIs(tgt.ip_info_get('8.8.8.8'), infos['8.8.8.8'])
+        tgt.ip_infos.clear()
+
+    def test_lru(self):
+        lru = tgt.LRU(3)
+        for n in range(3):
+            lru.set(n, str(n))
+        self.assertEqual(lru.get(0), '0')
+        lru.set(3, '3')
+        self.assertEqual(len(lru), 3)
+        self.assertIsNone(lru.get(1))
+        self.assertEqual(lru.get(0), '0')
+        self.assertEqual(lru.get(3), '3')
+        lru.clear()
+        self.assertEqual(lru.get(0, 'default'), 'default')
+
+    def test_alerts_schedule(self):
+        async def run():
+            # With LISTEN/NOTIFY alerts_watch publishes settings
+            now = tgt.datetime.utcnow().replace(microsecond=0)
+            minute = tgt.timedelta(minutes=1)
+            device = tgt.Device(id=-1, edit_token='x', notifyoff=True, email_confirmed=True, notified_down=False, 
+                notify_interval=60, updated=now)
+            tgt.alerts_watch(device)
+            tgt.alerts_schedule(-1, now + minute)
+            due = [ e for e in tgt.alerts.heap if e[1] == -1 and tgt.alerts.scheduled.get(-1) == e[2] ]
+            self.assertEqual(due, [(now + 2 * minute, -1, tgt.alerts.scheduled[-1])])
+            device.notifyoff = False
+            tgt.alerts_watch(device)
+            self.assertNotIn(-1, tgt.alerts.scheduled)
+            self.assertNotIn(-1, tgt.alerts.watched)
+            tgt.alerts_schedule(-1, now + 3 * minute)
+            self.assertNotIn(-1, tgt.alerts.scheduled)
+
+            # Down for too long when notifications are enabled: no alert, as on startup
+            device.notifyoff = True
+            device.updated = tgt.alerts_since(now) - minute
+            tgt.alerts_watch(device)
+            self.assertEqual(tgt.alerts.watched[-1], 60)
+            self.assertNotIn(-1, tgt.alerts.scheduled)
+            device.notifyoff = False
+            tgt.alerts_watch(device)
+
+            # Settings published by another process
+            tgt.ws_dispatch(['!-2'], {'interval': 60, 'updated': now.isoformat() + '+00:00', 'notified_down': False})
+            self.assertEqual(tgt.alerts.watched[-2], 60)
+            self.assertIn((now + minute, -2, tgt.alerts.scheduled[-2]), tgt.alerts.heap)
+            tgt.ws_dispatch(['!-2'], {'interval': None, 'updated': None, 'notified_down': False})
+            self.assertNotIn(-2, tgt.alerts.watched)
+
+        asyncio.run(run())
+        tgt.pubsub.pending = {}
+        tgt.pubsub.scheduled = False
+
+    def test_outbox_quota(self):
+        rate = tgt.MAILER_RATE
+        try:
+            tgt.MAILER_RATE = 5
+            tgt.outbox.claimed.clear()
+            tgt.outbox.claimed.extend([tgt.time.monotonic() - 61] * 3 + [tgt.time.monotonic()] * 2)
+            self.assertEqual(tgt.outbox_quota(), 3)
+            self.assertEqual(len(tgt.outbox.claimed), 2)
+            tgt.MAILER_RATE = 0
+            self.assertEqual(tgt.outbox_quota(), tgt.MAILER_POOL_SIZE * 4)
+        finally:
+            tgt.MAILER_RATE = rate
+            tgt.outbox.claimed.clear()
+
+    def test_outbox_retry(self):
+        class FailingMailer:
+            calls = 0
+            async def device_down(self, email, *args):
+                self.calls += 1
+                raise ConnectionError('mailer is down')
+
+        async def row(id):
+            async with tgt.autocommit.connect() as db:
+                return (await db.execute(tgt.select(tgt.Outbox.status, tgt.Outbox.attempts, tgt.Outbox.next_attempt, 
+                    tgt.Outbox.error).where(tgt.Outbox.id == id))).one()
+
+        async def run():
+            table = tgt.Outbox.__table__
+            # Due before any other email, so only this one is claimed
+            due = tgt.datetime(2000, 1, 1)
+            async with tgt.autocommit.connect() as db:
+                id = await db.scalar(table.insert().values(created=due, kind='device_down', email='retry@example.com', 
+                    args=['Title', 'token'], status='pending', attempts=0, next_attempt=due).returning(table.c.id))
+            try:
+                for attempt in range(1, tgt.MAILER_MAX_ATTEMPTS + 1):
+                    tgt.outbox.claimed.clear()
+                    before = tgt.datetime.utcnow()
+                    self.assertEqual(await tgt.outbox_send(), 1)
+                    status, attempts, next_attempt, error = await row(id)
+                    self.assertEqual(attempts, attempt)
+                    self.assertIn('mailer is down', error)
+                    delay = tgt.timedelta(seconds=tgt.MAILER_RETRY * 2 ** (attempt - 1))
+                    self.assertGreaterEqual(next_attempt, before + delay)
+                    self.assertLess(next_attempt, tgt.datetime.utcnow() + delay)
+                    self.assertEqual(status, 'failed' if attempt == tgt.MAILER_MAX_ATTEMPTS else 'pending')
+                    # Not due until the backoff ends
+                    tgt.outbox.claimed.clear()
+                    if status == 'pending':
+                        self.assertEqual(await tgt.outbox_send(), 0)
+                    async with tgt.autocommit.connect() as db:
+                        await db.execute(table.update().where(table.c.id == id).values(next_attempt=due))
+
+                # Parked after MAILER_MAX_ATTEMPTS
+                tgt.outbox.claimed.clear()
+                self.assertEqual(await tgt.outbox_send(), 0)
+                self.assertEqual(tgt.mailer.calls, tgt.MAILER_MAX_ATTEMPTS)
+            finally:
+                async with tgt.autocommit.connect() as db:
+                    await db.execute(table.delete().where(table.c.id == id))
+                await tgt.engine.dispose()
+
+        mailer, rate, max_attempts = tgt.mailer, tgt.MAILER_RATE, tgt.MAILER_MAX_ATTEMPTS
+        try:
+            tgt.mailer = FailingMailer()
+            tgt.MAILER_RATE = 1
+            tgt.MAILER_MAX_ATTEMPTS = 4
+            asyncio.run(run())
+        finally:
+            tgt.mailer, tgt.MAILER_RATE, tgt.MAILER_MAX_ATTEMPTS = mailer, rate, max_attempts
+            tgt.outbox.claimed.clear()
+
+    def test_ws_client(self):
+        class SlowSocket:
+            closed = False
+            async def send(self, msg):
+                await asyncio.sleep(10)
+            async def close(self):
+                self.closed = True
+
+        async def run():
+            wsocket = SlowSocket()
+            client = tgt.Client(wsocket)
+            for n in range(3):
+                self.assertTrue(client.send('refresh'))
+            self.assertEqual(client.queue.qsize(), 1)
+            # Writer is stuck on the first message
+            await asyncio.sleep(0)
+            self.assertTrue(client.send('refresh'))
+            for n in range(tgt.WEBSOCKET_QUEUE - 1):
+                self.assertTrue(client.send('{"id": %d}' % n))
+            # Full queue is replaced with one refresh, the socket stays open
+            dropped = tgt.metric_ws_dropped.value
+            self.assertTrue(client.send('{"id": 0}'))
+            self.assertEqual(tgt.metric_ws_dropped.value - dropped, tgt.WEBSOCKET_QUEUE + 1)
+            self.assertEqual(client.queue.get_nowait(), 'refresh')
+            self.assertTrue(client.queue.empty())
+            client.queue.put_nowait('refresh')
+            self.assertTrue(client.send('refresh'))
+            for n in range(tgt.WEBSOCKET_QUEUE - 1):
+                self.assertTrue(client.send('.'))
+            self.assertTrue(client.send('.'))
+            self.assertEqual(client.queue.qsize(), 1)
+            self.assertFalse(client.closed)
+
+            client.close()
+            self.assertFalse(client.send('.'))
+            await asyncio.sleep(0)
+            self.assertTrue(wsocket.closed)
+            with self.assertRaises(asyncio.CancelledError):
+                await client.writer
+
+        asyncio.run(run())
+
+    def test_ws_reap(self):
+        class Socket:
+            async def send(self, msg):
+                pass
+            async def close(self):
+                pass
+
+        async def run():
+            now = time.monotonic()
+            tgt.ws.buckets = {}
+            tgt.ws.reaped = int(now) - 1
+            old, fresh = tgt.Client(Socket()), tgt.Client(Socket())
+            tgt.ws_subscribe(old, 'target')
+            tgt.ws_subscribe(fresh, 'target')
+            self.assertEqual(tgt.ws_reap(now), 0)
+            self.assertEqual(tgt.ws_reap(now + tgt.WEBSOCKET_TIMEOUT + 2), 2)
+            self.assertTrue(old.closed)
+            self.assertNotIn('target', tgt.ws.subscriptions)
+            self.assertEqual(tgt.ws.buckets, {})
+
+            tgt.ws.reaped = int(now) - 1
+            old, fresh = tgt.Client(Socket()), tgt.Client(Socket())
+            tgt.ws_subscribe(old, 'target')
+            tgt.ws_subscribe(fresh, 'target')
+            fresh.touch(now + tgt.WEBSOCKET_TIMEOUT)
+            self.assertEqual(tgt.ws_reap(now + tgt.WEBSOCKET_TIMEOUT + 2), 1)
+            self.assertTrue(old.closed)
+            self.assertFalse(fresh.closed)
+            self.assertEqual(tgt.ws.subscriptions['target'], {fresh})
+            tgt.ws_drop(fresh)
+            self.assertEqual(tgt.ws.buckets, {})
+
+        asyncio.run(run())
+
+    def test_admission(self):
+        now = tgt.datetime.utcnow()
+        self.assertIsNone(tgt.admission_heartbeat('token'))
+        tgt.admission_accept('token', now, 120)
+        res = tgt.admission_heartbeat('token')
+        self.assertEqual(res.body, b'too often')
+        self.assertEqual(res.headers['Refresh'], '120')
+        tgt.admission_accept('token', now - tgt.timedelta(seconds=tgt.MIN_INTERVAL), 120)
+        self.assertIsNone(tgt.admission_heartbeat('token'))
+        self.assertIsNone(tgt.admission.heartbeats.get('token'))
+
+        ip = '127.0.0.254'
+        # Only the number counted in the database is used
+        self.assertTrue(tgt.admission_register(ip, tgt.REG_PER_IP + 5))
+        tgt.admission_registered(ip, tgt.REG_PER_IP + 5)
+        self.assertTrue(tgt.admission_register(ip, 1))
+        tgt.admission_counted(ip, tgt.REG_PER_IP - 1)
+        self.assertTrue(tgt.admission_register(ip, 2))
+        self.assertFalse(tgt.admission_register(ip, 3))
+        tgt.admission_registered(ip, 1)
+        self.assertFalse(tgt.admission_register(ip, 2))
+        tgt.admission.registrations.get(ip)[1] -= tgt.REG_COUNT_CACHE
+        self.assertTrue(tgt.admission_register(ip, 2))
+        tgt.admission.registrations.pop(ip)
+
+    def test_notify_after_commit(self):
+        async def run():
+            for commit in (True, False):
+                session = tgt.Session()
+                device = tgt.Device(id=-3, public=False, view_token='v', edit_token=None)
+                session.add(device)
+                generation = tgt.responses.invalidated.get(-3)
+                tgt.notify_device(device)
+                self.assertEqual(tgt.responses.invalidated.get(-3), generation)
+                session.expunge(device)
+                session.commit() if commit else session.rollback()
+                self.assertEqual(tgt.responses.invalidated.get(-3) != generation, commit)
+                self.assertNotIn('notify', session.info)
+
+        asyncio.run(run())
+        tgt.pubsub.pending = {}
+        tgt.pubsub.scheduled = False
+
+    def test_heartbeat_flush(self):
+        async def device_row(id):
+            async with tgt.dba() as orm:
+                return (await orm.execute(tgt.select(tgt.Device.updated, tgt.func.count(tgt.Event.id))
+                    .outerjoin(tgt.Event, tgt.Event.device_id == tgt.Device.id).where(tgt.Device.id == id)
+                    .group_by(tgt.Device.id))).one()
+
+        async def run():
+            heartbeats = tgt.heartbeats
+            now = tgt.datetime.utcnow().replace(microsecond=0)
+            second = tgt.timedelta(seconds=1)
+            async with tgt.dba() as orm:
+                device = tgt.Device(update_token=tgt.random_str(), ip='127.0.0.77', interval=60, created=now - 60 * second, 
+                    updated=now - 60 * second, notified_down=False, version=0)
+                orm.add(device)
+                await orm.flush()
+                state = tgt.Heartbeat(device)
+                await orm.commit()
+            try:
+                heartbeats.ids[state.id] = state
+                heartbeats.tokens[state.update_token] = state
+                state.updated = now - 30 * second
+                heartbeats.dirty.add(state)
+                await tgt.heartbeat_flush()
+                self.assertEqual(heartbeats.dirty, set())
+                self.assertEqual(tuple(await device_row(state.id)), (now - 30 * second, 0))
+
+                # Alive message handled while the UPDATE is running
+                state.updated = now - 20 * second
+                heartbeats.dirty.add(state)
+                flush = asyncio.create_task(tgt.heartbeat_flush())
+                await asyncio.sleep(0)
+                self.assertEqual(heartbeats.dirty, set())
+                self.assertEqual(tgt.heartbeat_cached(state.update_token, '127.0.0.77').status, 200)
+                updated = state.updated
+                await flush
+                self.assertEqual(heartbeats.dirty, {state})
+                self.assertEqual(tuple(await device_row(state.id)), (now - 20 * second, 0))
+                await tgt.heartbeat_flush()
+                self.assertEqual(heartbeats.dirty, set())
+                self.assertEqual(tuple(await device_row(state.id)), (updated, 0))
+
+                # Never moves updated back
+                state.updated = now - 60 * second
+                heartbeats.dirty.add(state)
+                await tgt.heartbeat_flush()
+                self.assertEqual(tuple(await device_row(state.id)), (updated, 0))
+            finally:
+                heartbeats.ids.pop(state.id, None)
+                heartbeats.tokens.pop(state.update_token, None)
+                heartbeats.dirty.clear()
+                async with tgt.dba() as orm:
+                    await orm.execute(tgt.delete(tgt.Device).where(tgt.Device.id == state.id))
+                    await orm.commit()
+                await tgt.engine.dispose()
+
+        asyncio.run(run())
+        tgt.pubsub.pending = {}
+        tgt.pubsub.scheduled = False
+
+    def test_metrics(self):
+        family = tgt.metrics.histogram('test_seconds', 'Test', 'route')
+        for seconds in (0.0001, 0.003, 0.003, 100):
+            family.labels('a').observe(seconds)
+        lines = family.render()
+        self.assertIn('test_seconds_bucket{route="a",le="0.0005"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="0.0025"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="0.005"} 3', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="10"} 3', lines)
+        self.assertIn('test_seconds_bucket{route="a",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_count{route="a"} 4', lines)
+        tgt.metrics.families.remove(family)
+
+    def test_delta_merge(self):
+        a = {'id': 1, 'updated': 'a', 'version': 1, 'ip': 'ip1', 'events': [{'id': 1}]}
+        b = {'id': 1, 'updated': 'b', 'version': 2, 'events': [{'id': 2}]}
+        self.assertEqual(tgt.delta_merge(a, b), {'id': 1, 'updated': 'b', 'version': 2, 'ip': 'ip1', 
+            'events': [{'id': 1}, {'id': 2}]})
+        self.assertEqual(tgt.delta_merge({'id': 1, 'updated': 'a'}, {'id': 1, 'updated': 'b'}), {'id': 1, 'updated': 'b'})
+        self.assertIsNone(tgt.delta_merge(a, None))
+        self.assertIsNone(tgt.delta_merge(None, b))